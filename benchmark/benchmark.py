@@ -0,0 +1,546 @@
+"""
+Teljesítménymérés szintetikus korpuszon
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER / "updater"))
+sys.path.insert(0, str(REPO_FOLDER / "webservice"))
+sys.path.insert(0, str(REPO_FOLDER / "shared"))
+
+import script  # noqa: E402
+from http_cache import HttpCache  # noqa: E402
+from http_client import HttpClient  # noqa: E402
+from whoosh import index  # noqa: E402
+from whoosh.query import Regex  # noqa: E402
+from search import (  # noqa: E402
+    LineMatcher,
+    TrigramIndex,
+    build_filter,
+    build_query,
+    find_page_snippets,
+    match_positions,
+    search_page,
+)
+
+SESSION_NAMES = [
+    "Képviselő-testület",
+    "Pénzügyi és Költségvetési Bizottság",
+    "Városfejlesztési és Környezetvédelmi Bizottság",
+    "Humánszolgáltatási Bizottság",
+    "Ügyrendi Bizottság",
+    "Településrészi Önkormányzat",
+]
+
+AGENDA_TITLES = [
+    "Javaslat a {year}. évi költségvetés elfogadására",
+    "Javaslat a helyi építési szabályzat módosítására",
+    "Tájékoztató a lejárt határidejű határozatok végrehajtásáról",
+    "Javaslat közterület-használati díjak megállapítására",
+    "Javaslat a parkolási rendelet módosítására",
+    "Beszámoló a polgármesteri hivatal {year}. évi munkájáról",
+    "Javaslat önkormányzati bérlakások felújítására",
+    "Javaslat civil szervezetek támogatására",
+]
+
+# Stems and suffixes of the generated words; the combinations give the
+# large, agglutinated vocabulary the substring and regex search runs on
+STEMS = (
+    "önkormányzat képviselő bizottság költségvetés rendelet határozat javaslat "
+    "előterjesztés módosítás polgármester jegyző hivatal kerület Újbuda Gellérthegy "
+    "Kelenföld Lágymányos Albertfalva Sasad Őrmező tér utca út park parkoló ház "
+    "lakás bérlakás ingatlan telek közterület felújítás beruházás pályázat támogatás "
+    "szerződés közbeszerzés ajánlat vállalkozó iskola óvoda bölcsőde rendelő egészségügy "
+    "szociális ellátás segély díj adó bevétel kiadás tartalék hitel kötvény vagyon "
+    "gazdálkodás környezet zöldfelület fa kerékpár forgalom közlekedés villamos busz "
+    "szavazás elfogadás elutasítás tájékoztató beszámoló jegyzőkönyv meghívó napirend "
+    "sürgősségi zárt nyilvános ülés testület tag elnök alpolgármester osztály iroda"
+).split()
+SUFFIXES = [
+    "", "", "", "ok", "ek", "ak", "t", "ot", "et", "nak", "nek", "ban", "ben", "ba", "be",
+    "ból", "ből", "ról", "ről", "hoz", "hez", "val", "vel", "ra", "re", "on", "en", "ön",
+    "i", "ai", "ei", "ként", "ért", "ig", "ról", "unk", "ünk", "juk", "ük",
+]
+FILLERS = "a az és hogy nem is meg el ki be fel le van volt lesz mint ez az egy minden".split()
+# Recurring wording of the resolutions, for the phrase and exact searches
+PHRASES = [
+    "a Képviselő-testület elfogadja a javaslatot",
+    "a Bizottság támogatja az előterjesztés elfogadását",
+    "felkéri a polgármestert a szükséges intézkedések megtételére",
+    "a {year}. évi költségvetést az alábbiak szerint módosítja",
+    "Határidő: azonnal Felelős: polgármester",
+]
+
+QUERIES = [
+    # name, mode, search text, exact
+    ("term", "term", "költségvetést", True),
+    ("prefix", "term", "közterület", False),
+    ("substring", "substring", "parkoló", False),
+    ("substring_short", "substring", "ház", False),
+    ("phrase", "phrase", "tamogatja az eloterjesztes", False),
+    ("phrase_exact", "phrase", "támogatja az előterjesztés", True),
+    ("regex", "regex", "^park.*ban$", False),
+    ("regex_alternation", "regex", "(bölcsőd|óvod)ák", False),
+]
+
+
+def build_vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        stem = rng.choice(STEMS)
+        # Compound words as in "parkolóház" or "bérlakásfelújítás"
+        if rng.random() < 0.4:
+            stem += rng.choice(STEMS).lower()
+        words.add(stem + rng.choice(SUFFIXES))
+    return sorted(words)
+
+
+def create_tables(conn):
+    # Same columns as the tables the updater fills from the API
+    conn.execute(
+        f"""CREATE TABLE {script.ujbuda.db_folder} (folder_uuid TEXT, detail_uuid TEXT, datum TEXT,
+        name TEXT, testuletijelolo TEXT, targy TEXT, napirend TEXT, kategoria TEXT,
+        nyilvanossagjelolo TEXT, idopont TEXT, hely TEXT, gyujto TEXT, folapra TEXT,
+        eloterjeszto TEXT, dateLastModified TEXT, iktatoszam TEXT)"""
+    )
+    conn.execute(
+        f"""CREATE TABLE {script.ujbuda.db_napirendi} (uuid TEXT PRIMARY KEY, folder_uuid TEXT,
+        gyujto TEXT, targy TEXT, name TEXT, linkName TEXT, napirend TEXT, nyilvanossagjelolo TEXT,
+        hasPermissions TEXT, folapra TEXT, eloterjeszto TEXT, referencia TEXT)"""
+    )
+    conn.execute(
+        f"""CREATE TABLE {script.ujbuda.db_file_detail} (gyujto TEXT, nyilvanossagjelolo TEXT,
+        dateLastModified TEXT, statetext TEXT, name TEXT, userLastModified TEXT, filesize INTEGER,
+        uuid TEXT NOT NULL, agenda_uuid TEXT, folder_uuid TEXT)"""
+    )
+
+
+def write_document(txt_path, rng, vocabulary, weights, pages, lines_per_page, year):
+    # Pages end with a form feed like the output of the PDF extraction
+    with open(txt_path, "w", encoding="utf8") as out:
+        for _ in range(pages):
+            for _ in range(lines_per_page):
+                line_words = rng.choices(vocabulary, weights, k=rng.randint(6, 12))
+                for i in range(1, len(line_words), 4):
+                    line_words[i] = rng.choice(FILLERS)
+                if rng.random() < 0.02:
+                    line_words.append(rng.choice(PHRASES).format(year=year))
+                out.write(" ".join(line_words) + "\n")
+            out.write("\f")
+
+
+def generate_corpus(args):
+    """Write the txt tree and onkorm.db of a synthetic corpus into args.work_dir.
+
+    Returns the folder uuids in creation order.
+    """
+    rng = random.Random(args.seed)
+    vocabulary = build_vocabulary(rng, args.vocabulary)
+    # Zipf-like word frequencies
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    rng.shuffle(vocabulary)
+
+    folder_uuids = []
+    first_day = date(2015, 1, 1)
+    with sqlite3.connect(script.DATABASE_PATH) as conn:
+        create_tables(conn)
+        for _ in range(args.folders):
+            folder_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+            folder_uuids.append(folder_uuid)
+            session_date = first_day + timedelta(days=rng.randrange(365 * 10))
+            conn.execute(
+                f"INSERT INTO {script.ujbuda.db_folder} (folder_uuid, detail_uuid, datum, name, idopont, nyilvanossagjelolo) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    folder_uuid,
+                    str(uuid.UUID(int=rng.getrandbits(128))),
+                    session_date.strftime("%Y.%m.%d."),
+                    rng.choice(SESSION_NAMES),
+                    "10:00",
+                    "0",
+                ),
+            )
+
+            for agenda_number in range(1, args.agendas + 1):
+                agenda_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+                conn.execute(
+                    f"INSERT INTO {script.ujbuda.db_napirendi} (uuid, folder_uuid, targy, name, napirend, nyilvanossagjelolo) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        agenda_uuid,
+                        folder_uuid,
+                        rng.choice(AGENDA_TITLES).format(year=session_date.year),
+                        f"{agenda_number}. napirendi pont",
+                        str(agenda_number),
+                        "0",
+                    ),
+                )
+                agenda_folder = script.TXT_FOLDER / folder_uuid / agenda_uuid
+                os.makedirs(agenda_folder)
+
+                for file_number in range(1, args.files + 1):
+                    file_name = f"eloterjesztes_{agenda_number}_{file_number}.pdf"
+                    txt_path = agenda_folder / file_name.replace(".pdf", ".txt")
+                    write_document(
+                        txt_path, rng, vocabulary, weights,
+                        rng.randint(1, args.pages), args.lines, session_date.year,
+                    )
+                    conn.execute(
+                        f"INSERT INTO {script.ujbuda.db_file_detail} (name, filesize, uuid, agenda_uuid, folder_uuid, nyilvanossagjelolo) VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            file_name,
+                            txt_path.stat().st_size,
+                            str(uuid.UUID(int=rng.getrandbits(128))),
+                            agenda_uuid,
+                            folder_uuid,
+                            "0",
+                        ),
+                    )
+    return folder_uuids
+
+
+def crawl_replay(args):
+    """Crawl a capture of the API (script.py --http-cache record) into args.work_dir, offline.
+
+    Returns the folder uuids in listing order and the crawl timings.
+    """
+    cache = HttpCache(args.replay, script.HTTP_CACHE_TTLS, mode="replay")
+    client = HttpClient(max_connections=script.HTTP_CONNECTIONS, requests_per_second=0, cache=cache)
+    with sqlite3.connect(script.DATABASE_PATH) as conn:
+        create_tables(conn)
+    conn = script.open_database()
+    try:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(client.max_connections) as pool:
+            folder_uuids = [folder["folder_uuid"] for folder in script.find_missing_folders(client, pool, set())]
+        script.crawl_folders(client, conn, folder_uuids)
+        crawl_time = time.perf_counter() - start_time
+    finally:
+        client.close()
+        conn.close()
+
+    return folder_uuids, {
+        "folders": len(folder_uuids),
+        "responses": cache.hit_count,
+        "bytes": client.byte_count,
+        "seconds": round(crawl_time, 3),
+        "folders_per_s": round(len(folder_uuids) / crawl_time, 1),
+    }
+
+
+def timings(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def benchmark_reindex(args, folder_uuids):
+    """Time a full rebuild without the last folders, then an update adding them."""
+    update_uuids = folder_uuids[len(folder_uuids) - args.update_folders:] if args.update_folders else []
+    pending_folder = Path(args.work_dir) / "pending"
+    for folder_uuid in update_uuids:
+        # A replayed folder has no txt folder when every file is a copy of an earlier one
+        if (script.TXT_FOLDER / folder_uuid).exists():
+            shutil.move(script.TXT_FOLDER / folder_uuid, pending_folder / folder_uuid)
+
+    conn = script.open_database()
+    try:
+        start_time = time.perf_counter()
+        rebuild_docs = script.rebuild_index(conn, args.procs, args.limitmb, args.merge)
+        rebuild_time = time.perf_counter() - start_time
+
+        for folder_uuid in update_uuids:
+            if (pending_folder / folder_uuid).exists():
+                shutil.move(pending_folder / folder_uuid, script.TXT_FOLDER / folder_uuid)
+        start_time = time.perf_counter()
+        update_docs = script.update_index(conn, update_uuids) if update_uuids else 0
+        update_time = time.perf_counter() - start_time
+    finally:
+        conn.close()
+
+    return {
+        "rebuild": {
+            "documents": rebuild_docs,
+            "seconds": round(rebuild_time, 3),
+            "docs_per_s": round(rebuild_docs / rebuild_time, 1),
+            "procs": args.procs,
+            "limitmb": args.limitmb,
+            "merge": args.merge,
+        },
+        "update": {
+            "folders": len(update_uuids),
+            "documents": update_docs,
+            "seconds": round(update_time, 3),
+        },
+    }
+
+
+def build_baseline_query(search_text, exact_match):
+    """The query of the webservice before the optimizations, for every
+    search mode: the escaped text as a regex over the content terms.
+    """
+    pattern = rf"\b{re.escape(search_text)}\b" if exact_match else re.escape(search_text)
+    return Regex("content", pattern)
+
+
+def benchmark_search(args):
+    """Time the search and snippet path of the webservice for every query variant."""
+    index_dir = script.current_index_dir()
+    ix = index.open_dir(index_dir)
+    trigram_index = TrigramIndex(index_dir)
+
+    with ix.searcher() as searcher:
+        session_names = sorted(searcher.lexicon("session_name"))
+        dates = [fields["date"] for fields in searcher.all_stored_fields()]
+    # About a third of the sessions and half of the date range
+    first_date, last_date = min(dates), max(dates)
+    filter_query = build_filter(
+        ix.schema,
+        session_names=[name.decode("utf8") for name in session_names[::3]],
+        date_from=first_date + (last_date - first_date) / 4,
+        date_to=last_date - (last_date - first_date) / 4,
+    )
+
+    results = []
+    for name, mode, search_text, exact_match in QUERIES:
+        regex = mode == "regex"
+        # Term and prefix queries are what the webservice builds without a trigram index
+        query_trigrams = trigram_index if mode in ("substring", "regex") else None
+        for filtered in (False, True):
+            line_matcher = LineMatcher(ix.schema, search_text, exact_match, regex=regex)
+            active_filter = filter_query if filtered else None
+
+            search_times = []
+            position_times = []
+            snippet_times = []
+            scan_times = []
+            baseline_times = []
+            with ix.searcher() as searcher:
+                for _ in range(args.repeat):
+                    # A new query object, so memoized trigram candidates are looked up again
+                    query = build_query(ix.schema, search_text, exact_match, regex=regex, trigram_index=query_trigrams)
+                    start_time = time.perf_counter()
+                    page, _ = search_page(searcher, query, 1, args.page_size, filter_query=active_filter)
+                    search_times.append(time.perf_counter() - start_time)
+
+                    baseline_query = build_baseline_query(search_text, exact_match)
+                    start_time = time.perf_counter()
+                    baseline_page, _ = search_page(
+                        searcher, baseline_query, 1, args.page_size, filter_query=active_filter
+                    )
+                    baseline_times.append(time.perf_counter() - start_time)
+
+                start_time = time.perf_counter()
+                positions = match_positions(searcher, query, [hit.docnum for hit in page])
+                position_times.append(time.perf_counter() - start_time)
+
+                for hit in page:
+                    txt_path = script.TXT_FOLDER / hit["folder_uuid"] / hit["agenda_uuid"] / hit["file_name"]
+                    start_time = time.perf_counter()
+                    find_page_snippets(txt_path, positions.get(hit.docnum), line_matcher)
+                    snippet_times.append(time.perf_counter() - start_time)
+                    # Fallback without the sidecar, reading the whole file
+                    start_time = time.perf_counter()
+                    find_page_snippets(txt_path, None, line_matcher)
+                    scan_times.append(time.perf_counter() - start_time)
+
+            result = {
+                "name": name,
+                "mode": mode,
+                "query": str(query),
+                "exact": exact_match,
+                "filtered": filtered,
+                "hits": page.total,
+                "search": timings(search_times),
+                "match_positions_ms": round(position_times[0] * 1000, 3),
+                "baseline": {
+                    "query": str(baseline_query),
+                    "hits": baseline_page.total,
+                    "search": timings(baseline_times),
+                },
+            }
+            # A speedup only means something when both find the same documents
+            if baseline_page.results.docs() == page.results.docs():
+                result["baseline"]["speedup"] = round(
+                    result["baseline"]["search"]["p50_ms"] / max(result["search"]["p50_ms"], 0.001), 2
+                )
+            if snippet_times:
+                result["snippet"] = timings(snippet_times)
+                result["snippet_scan"] = timings(scan_times)
+            results.append(result)
+            print(
+                f"{name:18} {'filtered' if filtered else 'all':8} {page.total:6} hits, "
+                f"search p50 {result['search']['p50_ms']:8.2f} ms"
+                + (f", snippet p50 {result['snippet']['p50_ms']:.2f} ms" if snippet_times else "")
+                + (
+                    f", baseline p50 {result['baseline']['search']['p50_ms']:.2f} ms ({result['baseline']['speedup']:.1f}x)"
+                    if "speedup" in result["baseline"]
+                    else f", the baseline finds {baseline_page.total} other hits, not compared"
+                )
+            )
+    return results
+
+
+def corpus_stats():
+    txt_files = list(script.TXT_FOLDER.glob("*/*/*.txt"))
+    return {
+        "txt_files": len(txt_files),
+        "txt_bytes": sum(path.stat().st_size for path in txt_files),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_FOLDER, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline_path):
+    """Print the change of the main numbers against an earlier report."""
+    with open(baseline_path, encoding="utf8") as f:
+        baseline = json.load(f)
+
+    def change(old, new):
+        return f"{old:10.2f} -> {new:10.2f} ({(new - old) / old * 100:+.0f}%)" if old else f"{new:.2f}"
+
+    print(f"Compared with {baseline_path} ({baseline.get('commit')}, {baseline.get('created')})")
+    if baseline["corpus"] != report["corpus"]:
+        print("Warning: the reports were made on different corpora")
+    if baseline.get("crawl") and report.get("crawl"):
+        print(f"{'crawl':36} s  {change(baseline['crawl']['seconds'], report['crawl']['seconds'])}")
+    for stage in ("rebuild", "update"):
+        print(f"{stage:36} s  {change(baseline['reindex'][stage]['seconds'], report['reindex'][stage]['seconds'])}")
+    old_results = {(result["name"], result["filtered"]): result for result in baseline["search"]}
+    for result in report["search"]:
+        old_result = old_results.get((result["name"], result["filtered"]))
+        if old_result:
+            label = f"{result['name']} {'filtered' if result['filtered'] else 'all'}"
+            print(f"{label:36} ms {change(old_result['search']['p50_ms'], result['search']['p50_ms'])}")
+    # Every query against the baseline query of the same run
+    for result in report["search"]:
+        baseline_result = result.get("baseline")
+        if not baseline_result:
+            continue
+        label = f"{result['name']} {'filtered' if result['filtered'] else 'all'} vs baseline"
+        if "speedup" in baseline_result:
+            print(f"{label:36} ms {change(baseline_result['search']['p50_ms'], result['search']['p50_ms'])}")
+        else:
+            print(f"{label:36}    other hits: {baseline_result['hits']} -> {result['hits']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XI-Files benchmark on a synthetic corpus, offline")
+    parser.add_argument("--folders", type=int, default=100, help="number of sessions")
+    parser.add_argument("--agendas", type=int, default=5, help="agenda points per session")
+    parser.add_argument("--files", type=int, default=2, help="files per agenda point")
+    parser.add_argument("--pages", type=int, default=8, help="maximum pages per file")
+    parser.add_argument("--lines", type=int, default=40, help="lines per page")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="number of distinct words")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--update-folders", type=int, default=10, help="sessions added by the incremental update")
+    parser.add_argument("--procs", type=int, default=script.REBUILD_PROCS, help="indexing processes of the rebuild")
+    parser.add_argument("--limitmb", type=int, default=script.REBUILD_LIMITMB)
+    parser.add_argument("--merge", choices=["single", "segments"], default=script.REBUILD_MERGE)
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every query")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--work-dir", help="corpus and index folder, a temporary folder by default")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work folder")
+    parser.add_argument("--output", help="JSON report path, printed to stdout by default")
+    parser.add_argument("--compare", help="earlier JSON report to compare with")
+    parser.add_argument(
+        "--replay",
+        type=Path,
+        help="crawl a recorded API capture (script.py --http-cache record) instead of generating a corpus",
+    )
+    args = parser.parse_args()
+
+    temporary = args.work_dir is None
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="xi-bench-")
+    work_dir = Path(args.work_dir)
+    if (work_dir / "txt").exists():
+        parser.error(f"{work_dir} already holds a corpus")
+
+    # Everything the updater writes goes into the work folder
+    script.DATABASE_PATH = work_dir / "onkorm.db"
+    script.TXT_FOLDER = work_dir / "txt"
+    script.INDEX_FOLDER = work_dir / "whoosh_index_dir"
+    script.PDF_STORE_FOLDER = work_dir / "pdf_store"
+    os.makedirs(script.TXT_FOLDER)
+    os.makedirs(script.PDF_STORE_FOLDER / "tmp")
+    os.makedirs(work_dir / "pending")
+
+    try:
+        start_time = time.perf_counter()
+        crawl = None
+        if args.replay:
+            folder_uuids, crawl = crawl_replay(args)
+            corpus = dict(corpus_stats(), replay=str(args.replay), folders=len(folder_uuids))
+        else:
+            folder_uuids = generate_corpus(args)
+            corpus = dict(
+                corpus_stats(),
+                folders=args.folders,
+                agendas=args.agendas,
+                files=args.files,
+                pages=args.pages,
+                lines=args.lines,
+                vocabulary=args.vocabulary,
+                seed=args.seed,
+            )
+        generate_time = time.perf_counter() - start_time
+        print(f"Corpus: {corpus['txt_files']} files, {corpus['txt_bytes'] / 1e6:.1f} MB in {work_dir}")
+
+        report = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "host": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "corpus": corpus,
+            "generate_seconds": round(generate_time, 3),
+            "crawl": crawl,
+            "reindex": benchmark_reindex(args, folder_uuids),
+            "search": benchmark_search(args),
+        }
+    finally:
+        if temporary and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as out:
+            json.dump(report, out, indent=2, ensure_ascii=False, default=str)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=str))
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
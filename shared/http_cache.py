@@ -0,0 +1,292 @@
+"""
+On-disk cache of the mikrodat API responses, with record and replay
+
+Shared by the updater and the webservice: docker-compose passes this
+folder to both image builds (additional_contexts), and the scripts add it
+to sys.path when run from the repository. They share the cache folder in
+data/.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+MODES = ("off", "cache", "record", "replay")
+
+# Endpoint class of an API path; the TTLs are given per class
+ENDPOINT_CLASSES = [
+    ("years", re.compile(r"/inv/years$")),
+    ("folders", re.compile(r"/inv/folders$")),
+    ("detail", re.compile(r"/detail$")),
+    ("agenda", re.compile(r"/inv/list(test)?$")),
+    ("files", re.compile(r"/elo/djav$")),
+    ("getfile", re.compile(r"/getfile/")),
+]
+
+# Response headers kept with the body
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+# The updater and the webservice run as different users of one group
+FOLDER_MODE = 0o2775
+ENTRY_MODE = 0o664
+
+
+class ReplayMiss(requests.ConnectionError):
+    """The replayed folder holds no response for the URL."""
+
+
+def endpoint_class(url):
+    path = urlsplit(url).path
+    for name, pattern in ENDPOINT_CLASSES:
+        if pattern.search(path):
+            return name
+    return "other"
+
+
+def cache_key(url):
+    # Path and query only, so a capture of the live API replays under any base URL
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+class EntryBody:
+    """Raw body of a streamed cached response, read from the entry file,
+    which is closed at the end of the body.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def read(self, size=-1):
+        chunk = self.entry.read(size)
+        if not chunk:
+            self.entry.close()
+        return chunk
+
+    def close(self):
+        self.entry.close()
+
+
+def cached_response(url, meta, entry, stream=False):
+    response = requests.Response()
+    response.status_code = meta["status"]
+    response.headers = CaseInsensitiveDict(meta["headers"])
+    response.url = url
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    if stream:
+        response.raw = EntryBody(entry)
+    else:
+        with entry:
+            response._content = entry.read()
+        response._content_consumed = True
+    return response
+
+
+class HttpCache:
+    """GET responses of the API stored under folder, one file per URL.
+
+    Modes:
+    - "off": every request goes to the server.
+    - "cache": an entry younger than the TTL of its endpoint class is
+      served from disk. An older one is revalidated with If-None-Match /
+      If-Modified-Since when the server sent an ETag or Last-Modified; a
+      304 answer renews it. Classes with a TTL of None (the PDFs) are not
+      cached.
+    - "record": every request goes to the server and every 200 answer is
+      stored, the PDFs too, so the folder can be replayed later.
+    - "replay": everything is served from the folder whatever its age, the
+      server is never contacted; a missing entry raises ReplayMiss.
+
+    Streamed responses (stream=True) are written to the entry as the
+    caller iterates over them and replayed from the file, so a PDF is
+    never held in memory. Safe to share between threads and processes:
+    entries are written to a temporary file and renamed. The age of an
+    entry is the mtime of its file.
+    """
+
+    def __init__(self, folder, ttls, mode="cache"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown HTTP cache mode {mode!r}, expected one of {', '.join(MODES)}")
+        self.folder = Path(folder)
+        self.ttls = ttls
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.hit_count = 0
+            self.revalidated_count = 0
+            self.stored_count = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def entry_path(self, url):
+        digest = hashlib.sha1(cache_key(url).encode("utf8")).hexdigest()
+        return self.folder / endpoint_class(url) / digest[:2] / digest
+
+    def make_folder(self, folder):
+        if folder.is_dir():
+            return
+        self.make_folder(folder.parent)
+        try:
+            folder.mkdir()
+            os.chmod(folder, FOLDER_MODE)
+        except FileExistsError:
+            pass
+
+    def open_entry(self, url):
+        """Return (meta, file positioned at the body, age in seconds), or Nones."""
+        try:
+            entry = open(self.entry_path(url), "rb")
+        except OSError:
+            return None, None, None
+        try:
+            meta = json.loads(entry.readline())
+            age = time.time() - os.fstat(entry.fileno()).st_mtime
+        except (OSError, ValueError):
+            entry.close()
+            return None, None, None
+        return meta, entry, age
+
+    def create_entry(self, url, meta):
+        """Return (file, temporary path) of a new entry with meta written,
+        or None when it cannot be written.
+
+        Best effort: a missing cache entry only costs a request.
+        """
+        path = self.entry_path(url)
+        try:
+            self.make_folder(path.parent)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        except OSError as e:
+            logging.warning(f"HTTP cache entry of {meta['url']} not written: {e}")
+            return None
+        os.fchmod(fd, ENTRY_MODE)
+        entry = os.fdopen(fd, "wb")
+        entry.write(json.dumps(meta, ensure_ascii=False).encode("utf8") + b"\n")
+        return entry, tmp_path
+
+    def finish_entry(self, url, new_entry, complete):
+        entry, tmp_path = new_entry
+        entry.close()
+        if complete:
+            os.replace(tmp_path, self.entry_path(url))
+            self.count("stored_count")
+        else:
+            os.unlink(tmp_path)
+
+    def store(self, url, response, stream=False):
+        meta = {
+            "url": cache_key(url),
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+        }
+        if not stream:
+            new_entry = self.create_entry(url, meta)
+            if new_entry:
+                try:
+                    new_entry[0].write(response.content)
+                except BaseException:
+                    self.finish_entry(url, new_entry, False)
+                    raise
+                self.finish_entry(url, new_entry, True)
+            return
+
+        # The chunks go to the entry as the caller reads them; a body not
+        # read to the end is not stored
+        iter_content = response.iter_content
+
+        def tee(chunk_size=1, decode_unicode=False):
+            new_entry = self.create_entry(url, meta)
+            complete = False
+            try:
+                for chunk in iter_content(chunk_size, decode_unicode):
+                    if new_entry:
+                        new_entry[0].write(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                if new_entry:
+                    self.finish_entry(url, new_entry, complete)
+
+        response.iter_content = tee
+
+    def get(self, url, fetch, **kwargs):
+        """Return the response for url, calling fetch(url, **kwargs) when
+        the server has to be asked.
+
+        fetch is e.g. requests.Session.get; it gets the conditional request
+        headers in headers=.
+        """
+        stream = kwargs.get("stream", False)
+        if self.mode == "off":
+            return fetch(url, **kwargs)
+        if self.mode == "record":
+            response = fetch(url, **kwargs)
+            if response.status_code == 200:
+                self.store(url, response, stream)
+            return response
+
+        if self.mode == "replay":
+            meta, entry, age = self.open_entry(url)
+            if meta is None:
+                raise ReplayMiss(f"No recorded response for {cache_key(url)} in {self.folder}")
+            self.count("hit_count")
+            return cached_response(url, meta, entry, stream)
+
+        ttl = self.ttls.get(endpoint_class(url))
+        if ttl is None:
+            return fetch(url, **kwargs)
+        meta, entry, age = self.open_entry(url)
+        if meta is not None and age < ttl:
+            self.count("hit_count")
+            return cached_response(url, meta, entry, stream)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if meta is not None:
+            if "ETag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if "Last-Modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        try:
+            response = fetch(url, headers=headers, **kwargs)
+        except BaseException:
+            if entry:
+                entry.close()
+            raise
+        if response.status_code == 304 and meta is not None:
+            response.close()
+            try:
+                os.utime(self.entry_path(url))
+            except OSError:
+                pass  # revalidated again next time
+            self.count("revalidated_count")
+            return cached_response(url, meta, entry, stream)
+        if entry:
+            entry.close()
+        if response.status_code == 200:
+            self.store(url, response, stream)
+        return response
+
+
+class CachedSession(requests.Session):
+    """requests.Session whose GETs go through an HttpCache."""
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def get(self, url, **kwargs):
+        return self.cache.get(url, super().get, **kwargs)
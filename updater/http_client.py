@@ -0,0 +1,121 @@
+"""
+Pooled HTTP client for the mikrodat API
+"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HostLimiter:
+    """Limits the concurrent requests and the request rate to one host."""
+
+    def __init__(self, max_connections, requests_per_second):
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def __enter__(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.slots.release()
+
+
+class HttpClient:
+    """requests.Session with keep-alive connection pooling, per-host
+    concurrency and rate limits, retry with exponential backoff, and
+    throughput counters. Safe to share between threads.
+
+    With an HttpCache the GETs go through it; its hits take no connection
+    slot and are not counted as requests.
+    """
+
+    def __init__(self, max_connections=8, requests_per_second=10, retries=3, backoff_factor=0.5, cache=None):
+        self.max_connections = max_connections
+        self.requests_per_second = requests_per_second
+        self.cache = cache
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_count = 0
+            self.retry_count = 0
+            self.byte_count = 0
+            self.start_time = time.perf_counter()
+        if self.cache:
+            self.cache.reset_counters()
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(self.max_connections, self.requests_per_second)
+            return self.limiters[host]
+
+    def get(self, url, timeout=10, **kwargs):
+        if self.cache:
+            return self.cache.get(url, self.fetch, timeout=timeout, **kwargs)
+        return self.fetch(url, timeout=timeout, **kwargs)
+
+    def fetch(self, url, timeout=10, **kwargs):
+        with self.limiter(url):
+            response = self.session.get(url, timeout=timeout, **kwargs)
+            retries = len(response.raw.retries.history) if response.raw.retries else 0
+            # Streamed bodies are counted by the caller with count_bytes()
+            size = 0 if kwargs.get("stream") else len(response.content)
+        with self.lock:
+            self.request_count += 1
+            self.retry_count += retries
+            self.byte_count += size
+        return response
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.byte_count += size
+
+    def log_throughput(self):
+        elapsed_time = time.perf_counter() - self.start_time
+        message = (
+            f"HTTP: {self.request_count} requests ({self.retry_count} retries), "
+            f"{self.byte_count / 1e6:.1f} MB in {elapsed_time:.1f} s: "
+            f"{self.request_count / elapsed_time:.1f} requests/s, "
+            f"{self.byte_count / 1e6 / elapsed_time:.2f} MB/s"
+        )
+        if self.cache and self.cache.mode != "off":
+            message += (
+                f"; cache ({self.cache.mode}): {self.cache.hit_count} hits, "
+                f"{self.cache.revalidated_count} revalidated, {self.cache.stored_count} stored"
+            )
+        print(message)
+        logging.info(message)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,154 @@
+"""
+Stage timings and counters of an updater run
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class LevelCounter(logging.Handler):
+    """Counts the warnings and errors logged during the run."""
+
+    def __init__(self, metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        self.metrics.count("errors" if record.levelno >= logging.ERROR else "warnings")
+
+
+class RunMetrics:
+    """Timing spans per stage and counters of one run. Safe to share between threads.
+
+    A stage may run many spans, also concurrently (e.g. one per download),
+    so both the summed span time and the wall time from the start of the
+    first span to the end of the last one are kept.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new run, e.g. the next update of the daemon."""
+        with self.lock:
+            self.start_time = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.success = None
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.time() - start_time, start_time)
+
+    def add_span(self, name, seconds, start_time):
+        """Record a span measured elsewhere, e.g. in another process."""
+        end_time = start_time + seconds
+        with self.lock:
+            stage = self.stages.setdefault(
+                name, {"spans": 0, "seconds": 0.0, "max_seconds": 0.0, "first_start": start_time, "last_end": end_time}
+            )
+            stage["spans"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+            stage["first_start"] = min(stage["first_start"], start_time)
+            stage["last_end"] = max(stage["last_end"], end_time)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                "start": datetime.fromtimestamp(self.start_time).isoformat(timespec="seconds"),
+                "duration_seconds": round(time.time() - self.start_time, 3),
+                "success": self.success,
+                "stages": {
+                    name: {
+                        "spans": stage["spans"],
+                        "seconds": round(stage["seconds"], 3),
+                        "wall_seconds": round(stage["last_end"] - stage["first_start"], 3),
+                        "max_seconds": round(stage["max_seconds"], 3),
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def prometheus_text(self, summary, prefix="xifiles_updater"):
+        lines = [
+            f"# HELP {prefix}_last_run_timestamp_seconds Start of the last updater run.",
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {self.start_time:.0f}",
+            f"# HELP {prefix}_last_run_success Whether the last updater run finished without an exception.",
+            f"# TYPE {prefix}_last_run_success gauge",
+            f"{prefix}_last_run_success {int(bool(summary['success']))}",
+            f"# HELP {prefix}_run_duration_seconds Duration of the last updater run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {summary['duration_seconds']}",
+        ]
+
+        stage_metrics = (
+            ("spans", "stage_spans", "Timed spans of the stage in the last run."),
+            ("seconds", "stage_seconds", "Summed span time of the stage in the last run."),
+            ("wall_seconds", "stage_wall_seconds", "Wall time from the first span to the end of the last one."),
+            ("max_seconds", "stage_max_seconds", "Longest span of the stage in the last run."),
+        )
+        for key, metric_name, help_text in stage_metrics:
+            lines.append(f"# HELP {prefix}_{metric_name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric_name} gauge")
+            for stage_name, stage in sorted(summary["stages"].items()):
+                lines.append(f'{prefix}_{metric_name}{{stage="{stage_name}"}} {stage[key]}')
+
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# HELP {prefix}_{name} Counted in the last run.")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_folder, runs_kept=100):
+        """Write the JSON summary of the run and the Prometheus textfile.
+
+        The summaries are kept as run-<start>.json (the last `runs_kept`)
+        and latest.json. updater.prom is for the textfile collector of the
+        node exporter; both are replaced atomically.
+        """
+        summary = self.summary()
+        os.makedirs(metrics_folder, exist_ok=True)
+
+        run_path = metrics_folder / f"run-{datetime.fromtimestamp(self.start_time):%Y%m%d-%H%M%S}.json"
+        with open(run_path, "w", encoding="utf8") as out:
+            json.dump(summary, out, indent=2)
+        for path, text in (
+            (metrics_folder / "latest.json", json.dumps(summary, indent=2)),
+            (metrics_folder / "updater.prom", self.prometheus_text(summary)),
+        ):
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf8") as out:
+                out.write(text)
+            os.replace(tmp_path, path)
+
+        for old_path in sorted(metrics_folder.glob("run-*.json"))[:-runs_kept]:
+            os.remove(old_path)
+        return summary
+
+    def log_summary(self, summary):
+        stages = sorted(summary["stages"].items(), key=lambda item: item[1]["wall_seconds"], reverse=True)
+        message = f"Run took {summary['duration_seconds']:.1f} s. Stages by wall time: " + ", ".join(
+            f"{name} {stage['wall_seconds']:.2f} s ({stage['spans']} spans, {stage['seconds']:.2f} s summed)"
+            for name, stage in stages
+        )
+        print(message)
+        logging.info(message)
+        message = "Counters: " + ", ".join(f"{name}={value}" for name, value in sorted(summary["counters"].items()))
+        print(message)
+        logging.info(message)
@@ -2,49 +2,132 @@
 XI-Files 
 Több mindent, kevesebb semmit!
 """
+import argparse
+import fcntl
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
+import re
 import requests
+import resource
 import sqlite3
 import time
-import pandas as pd
 import shutil
+import struct
+import sys
+import threading
 import warnings
+import zlib
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import fitz  # pymupdf
+import numpy as np
 from whoosh import index
 from whoosh.index import create_in
-from whoosh.fields import Schema, TEXT, ID, DATETIME
+from whoosh.analysis import CharsetFilter, RegexTokenizer, StandardAnalyzer
+from whoosh.fields import Schema, TEXT, ID, DATETIME, NUMERIC, STORED
+from whoosh.query import Term
+from whoosh.support.charset import accent_map
+
+from http_client import HttpClient
+from metrics import LevelCounter, RunMetrics
+
+# http_cache.py is shared with the webservice; the image has it next to this file
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from http_cache import MODES as HTTP_CACHE_MODES, HttpCache  # noqa: E402
 
 warnings.filterwarnings("ignore")
 env = "test"
 
 # Paths
 if env == "prod":
-    DATABASE_PATH = Path("./data/onkorm.db")
+    DATABASE_PATH = Path("./data/db/onkorm.db")
     LOG_FILE_PATH = Path("./log/download.log")
     INDEX_FOLDER = Path("./data/whoosh_index_dir")
-    PDF_FOLDER = Path("./data/pdf")
+    PDF_STORE_FOLDER = Path("./data/pdf_store")
     TXT_FOLDER = Path("./data/txt")
+    METRICS_FOLDER = Path("./data/metrics")
+    LOCK_PATH = Path("./data/updater.lock")
+    HTTP_CACHE_FOLDER = Path("./data/http_cache")
 
 if env == "test":
-    DATABASE_PATH = Path("../data/onkorm.db")
+    DATABASE_PATH = Path("../data/db/onkorm.db")
     LOG_FILE_PATH = Path("./log/download.log")
     INDEX_FOLDER = Path("../data/whoosh_index_dir")
-    PDF_FOLDER = Path("../data/pdf")
+    PDF_STORE_FOLDER = Path("../data/pdf_store")
     TXT_FOLDER = Path("../data/txt")
+    METRICS_FOLDER = Path("../data/metrics")
+    LOCK_PATH = Path("../data/updater.lock")
+    HTTP_CACHE_FOLDER = Path("../data/http_cache")
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    filename=LOG_FILE_PATH,
-    filemode="a",
-)
+# The webservice and the api read onkorm.db as shareduser (uid and gid 1000, see
+# webservice/Dockerfile). A WAL reader has to create onkorm.db-shm when no writer
+# is connected, so the db folder and files get this group and are group-writable;
+# the rest of the data folder stays read-only for them.
+SHARED_GID = 1000
+
+# Crawler
+HTTP_CONNECTIONS = 8  # concurrent requests per host
+HTTP_REQUESTS_PER_SECOND = 10  # per host
+HTTP_RETRIES = 3
+FOLDER_WORKERS = 4
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# API response cache in HTTP_CACHE_FOLDER, shared with the webservice (see http_cache.py).
+# "record" captures every response, PDFs included, "replay" runs offline from a capture.
+HTTP_CACHE_MODE = "cache"
+HTTP_CACHE_TTLS = {  # seconds per endpoint class; 0: revalidate every time, None: not cached
+    "years": 60 * 60,
+    "folders": 0,  # new folders must show up at the next run
+    "detail": 7 * 24 * 60 * 60,
+    "agenda": 7 * 24 * 60 * 60,
+    "files": 7 * 24 * 60 * 60,
+    "getfile": None,  # the downloaded PDFs are kept in PDF_STORE_FOLDER
+    "other": None,
+}
+
+# PDF to text
+EXTRACT_WORKERS = os.cpu_count() or 1
+
+# Duplicate documents: files whose extracted text is the same (whitespace
+# aside) share the txt and the index entry of the first one. A PDF already
+# extracted under another uuid is not extracted again.
+NEAR_DUPLICATES = False  # also merge texts with a MinHash similarity of at least NEAR_DUPLICATE_THRESHOLD
+NEAR_DUPLICATE_THRESHOLD = 0.9
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 5
+
+# Full rebuild
+REBUILD_PROCS = os.cpu_count() or 1  # indexing processes
+REBUILD_LIMITMB = 256  # memory limit of each indexing process
+REBUILD_MERGE = "single"  # "single": merge into one segment at commit, "segments": keep one segment per process
+
+# Trigram lookup of the content_folded terms, written into every index generation
+TRIGRAM_MAX_SEGMENTS = 8  # more segment files are merged into one
 
+# Index generations: INDEX_FOLDER/generations/<name>, INDEX_FOLDER/current links to the published one
+INDEX_GENERATIONS_KEPT = 3  # published generations kept for rollback
+
+# SQLite FTS5 table in onkorm.db for the fts5 backend of the webservice, one row per page
+FTS_INDEX = True
+
+# Daemon mode (--daemon): after a full pass the folder list of every year is
+# polled on its own schedule, closed years rarely; 0 means never again
+POLL_INTERVAL_CURRENT_YEAR = 60  # seconds
+POLL_INTERVAL_PREVIOUS_YEAR = 15 * 60
+POLL_INTERVAL_CLOSED_YEARS = 24 * 60 * 60
+YEARS_POLL_INTERVAL = 60 * 60  # inv/years, for a new year
+
+# Run metrics: METRICS_FOLDER/run-<start>.json, latest.json and updater.prom (Prometheus textfile collector)
+METRICS_RUNS_KEPT = 100
 
 @dataclass
 class Onkorm:
@@ -55,6 +138,7 @@ class Onkorm:
     db_folder: str
     db_napirendi: str
     db_file_detail: str
+    db_fts: str
 
 
 ujbuda = Onkorm(
@@ -63,19 +147,112 @@ ujbuda = Onkorm(
     db_folder="ujbuda_meghivo_mappa",
     db_napirendi="ujbuda_napirendi",
     db_file_detail="ujbuda_file_det",
+    db_fts="ujbuda_fts",
 )
 
+# Stage timings and counters of the run, written by main()
+metrics = RunMetrics()
+
+
+def open_database():
+    """Open the connection used for the whole run and prepare the tables."""
+    conn = sqlite3.connect(DATABASE_PATH)
+    # WAL lets the webservice keep reading while the updater writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    prepare_tables(conn)
+    return conn
+
+
+def prepare_database_folder():
+    """Create the folder of onkorm.db, moving a database left in the data
+    folder by earlier versions into it. Called under the run lock.
+    """
+    DATABASE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    legacy_path = DATABASE_PATH.parent.parent / DATABASE_PATH.name
+    if legacy_path.exists() and not DATABASE_PATH.exists():
+        # The -wal file holds committed transactions, it moves with the database
+        for suffix in ("", "-wal", "-shm"):
+            source = legacy_path.with_name(legacy_path.name + suffix)
+            if source.exists():
+                os.replace(source, DATABASE_PATH.with_name(DATABASE_PATH.name + suffix))
+        logging.info(f"Moved {legacy_path} to {DATABASE_PATH}")
+
+
+def share_path(path, mode):
+    """Give path to SHARED_GID with the given (group-writable) mode."""
+    try:
+        if os.geteuid() == 0:
+            os.chown(path, -1, SHARED_GID)
+        os.chmod(path, mode)
+    except OSError as e:
+        logging.warning(f"Cannot make {path} writable for group {SHARED_GID}: {e}")
+
+
+def share_database():
+    """Give the db folder and files to SHARED_GID, group-writable.
+
+    SQLite creates the -wal and -shm files with the mode and owner of the
+    database file, and the setgid folder passes its group on to them.
+    """
+    share_path(DATABASE_PATH.parent, 0o2775)
+    for path in (DATABASE_PATH, DATABASE_PATH.with_name(DATABASE_PATH.name + "-wal"),
+                 DATABASE_PATH.with_name(DATABASE_PATH.name + "-shm")):
+        if path.exists():
+            share_path(path, 0o664)
+
+
+def prepare_tables(conn):
+    """Add the columns and indexes the updater relies on if they are missing."""
+    cursor = conn.cursor()
+
+    cursor.execute(f"PRAGMA table_info({ujbuda.db_file_detail})")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "sha256" not in columns:
+        cursor.execute(f"ALTER TABLE {ujbuda.db_file_detail} ADD COLUMN sha256 TEXT")
+    if "download_size" not in columns:
+        cursor.execute(f"ALTER TABLE {ujbuda.db_file_detail} ADD COLUMN download_size INTEGER")
+    # content_uuid: the file whose txt holds this file's text, its own uuid if
+    # it is the first copy, NULL if not fingerprinted yet
+    for column, column_type in (("text_sha256", "TEXT"), ("minhash", "BLOB"), ("content_uuid", "TEXT")):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE {ujbuda.db_file_detail} ADD COLUMN {column} {column_type}")
+
+    # Unique keys for INSERT OR IGNORE (the uuid of db_napirendi is its primary key)
+    for table_name, column in ((ujbuda.db_folder, "folder_uuid"), (ujbuda.db_file_detail, "uuid")):
+        index_name = f"{table_name}_{column}_idx"
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,))
+        if cursor.fetchone():
+            continue
+
+        cursor.execute(
+            f"""DELETE FROM {table_name}
+            WHERE {column} IS NOT NULL AND rowid NOT IN (
+                SELECT MIN(rowid) FROM {table_name} WHERE {column} IS NOT NULL GROUP BY {column}
+            )"""
+        )
+        if cursor.rowcount:
+            logging.warning(f"Removed {cursor.rowcount} duplicate rows from {table_name}")
+        cursor.execute(f"CREATE UNIQUE INDEX {index_name} ON {table_name} ({column})")
 
-def fetch_data_from_db(database_path, table_name):
-    with sqlite3.connect(database_path) as conn:
-        query = f"SELECT * FROM {table_name}"
-        df = pd.read_sql_query(query, conn)
-    return df
+    # Per folder lookups while crawling and indexing
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {ujbuda.db_napirendi}_folder_uuid_idx ON {ujbuda.db_napirendi} (folder_uuid)"
+    )
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {ujbuda.db_file_detail}_folder_uuid_idx ON {ujbuda.db_file_detail} (folder_uuid, agenda_uuid, name)"
+    )
+    # Copies of a document, and the first copy of a PDF or text
+    for column in ("content_uuid", "sha256", "text_sha256"):
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {ujbuda.db_file_detail}_{column}_idx ON {ujbuda.db_file_detail} ({column})"
+        )
+    conn.commit()
 
 
-def fetch_json(url):
+def fetch_json(client, url):
     try:
-        response = requests.get(url, verify=False, timeout=10)
+        response = client.get(url, verify=False, timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
@@ -83,92 +260,744 @@ def fetch_json(url):
         return None
 
 
-def insert_into_table(conn, table_name, data):
+def insert_rows(conn, table_name, rows):
+    """INSERT OR IGNORE dict rows with one executemany per set of columns.
+
+    Rows whose unique key is already in the table are skipped. If a batch
+    fails, its rows are retried one by one so a bad row only loses itself.
+    Does not commit. Returns the number of inserted rows.
+    """
+    batches = {}
+    for row in rows:
+        batches.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+    before = conn.total_changes
+    for columns, values in batches.items():
+        placeholders = ", ".join(["?"] * len(columns))
+        insert_query = f"INSERT OR IGNORE INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+        try:
+            conn.executemany(insert_query, values)
+        except sqlite3.Error as e:
+            logging.error(f"Database error while inserting into {table_name}, retrying row by row: {e}")
+            for row_values in values:
+                try:
+                    conn.execute(insert_query, row_values)
+                except sqlite3.Error as e:
+                    print(e)
+                    logging.error(f"Database error while inserting values {row_values}: {e}")
+    return conn.total_changes - before
+
+
+def build_schema():
+    # content keeps the original word forms for exact phrases, content_folded
+    # is case- and accent-folded for the default search mode. An entry stands
+    # for every copy of a document: session_name holds the session names of
+    # the copies one per line, indexed as untokenized facets, dates their
+    # dates and session_dates the session_date_key() of every copy, so the
+    # webservice can filter on them inside the search. date is the newest
+    # copy's for the ordering, copies the links of every copy.
+    return Schema(file_name=TEXT(stored=True),
+                  date=DATETIME(stored=True,sortable=True),
+                  dates=DATETIME(),
+                  session_dates=NUMERIC(bits=64),
+                  folder_uuid=ID(stored=True),
+                  agenda_uuid=ID(stored=True),
+                  document_uuid=ID(stored=True, unique=True),
+                  session_name=TEXT(stored=True, analyzer=RegexTokenizer(r"[^\n]+"), phrase=False),
+                  agenda_title=STORED,
+                  copies=STORED,
+                  content=TEXT(phrase=True),
+                  content_folded=TEXT(analyzer=StandardAnalyzer() | CharsetFilter(accent_map), phrase=True))
+
+
+def session_date_key(session_name, date):
+    """Number of a session name and date pair, the webservice filters ranges of it."""
+    return zlib.crc32((session_name or "").encode("utf8")) * 100000000 + int(date.strftime("%Y%m%d"))
+
+
+def schema_signature(schema):
+    return [
+        (name, type(field_type).__name__, field_type.stored, field_type.unique)
+        for name, field_type in schema.items()
+    ]
+
+
+def read_txt_content(txt_path):
+    with open(txt_path, "r") as f:
+        stripped_lines = (line.strip() for line in f)
+        return " ".join(line.replace("/n","") for line in stripped_lines if line)
+
+
+def line_offsets_path(txt_path):
+    return txt_path.with_name(txt_path.name + ".lines")
+
+
+def write_line_offsets(txt_path, analyzer):
+    """Write the line/page offset sidecar of a txt file.
+
+    The webservice uses it to jump from an indexed word position straight to
+    the matching lines. Layout, in native byte order after a 16 byte header
+    (magic, line count, page count, padding): the byte offset of every line
+    (uint64) and the position of its first indexed word (uint32), both with a
+    closing entry, then the first line of every page (uint32).
+    """
+    byte_offsets = array("Q", [0])
+    word_positions = array("I", [0])
+    page_lines = array("I", [0])
+
+    with open(txt_path, "rb") as f:
+        for line_number, raw_line in enumerate(f):
+            line = raw_line.decode("utf8", errors="replace")
+            # Pages end with a form feed, the next page starts after it
+            for part in line.split("\f")[1:]:
+                page_lines.append(line_number if part.strip() else line_number + 1)
+
+            words = sum(1 for _ in analyzer(line.strip().replace("/n","")))
+            byte_offsets.append(byte_offsets[-1] + len(raw_line))
+            word_positions.append(word_positions[-1] + words)
+
+    line_count = len(byte_offsets) - 1
+    while len(page_lines) > 1 and page_lines[-1] >= line_count:
+        page_lines.pop()
+
+    with open(line_offsets_path(txt_path), "wb") as out:
+        out.write(struct.pack("<4sIII", b"XIL1", line_count, len(page_lines), 0))
+        out.write(byte_offsets.tobytes())
+        out.write(word_positions.tobytes())
+        out.write(page_lines.tobytes())
+
+
+def make_index_document(txt_path, content_analyzer, **fields):
+    sidecar_path = line_offsets_path(txt_path)
+    if not sidecar_path.exists() or sidecar_path.stat().st_mtime < txt_path.stat().st_mtime:
+        write_line_offsets(txt_path, content_analyzer)
+
+    content = read_txt_content(txt_path)
+    return dict(file_name=txt_path.name, content=content, content_folded=content, **fields)
+
+
+def iter_group_documents(conn, folder_uuids=None):
+    """Yield one index document per stored text, for every copy of it.
+
+    Files are grouped by content_uuid (a file not fingerprinted yet is a
+    group of its own). The txt of the first copy is indexed under its uuid;
+    the copies without a valid session date are left out. With folder_uuids
+    only the groups having a copy in these folders are yielded.
+    """
+    content_analyzer = build_schema()["content"].analyzer
+    group_filter = ""
+    params = []
+    if folder_uuids is not None:
+        placeholders = ", ".join("?" * len(folder_uuids))
+        group_filter = f"""WHERE COALESCE(f.content_uuid, f.uuid) IN (
+            SELECT COALESCE(content_uuid, uuid) FROM {ujbuda.db_file_detail} WHERE folder_uuid IN ({placeholders})
+        )"""
+        params = list(folder_uuids)
+    rows = conn.execute(
+        f"""SELECT COALESCE(f.content_uuid, f.uuid) AS group_uuid,
+            f.folder_uuid, f.agenda_uuid, f.name, f.uuid, m.datum, m.name, n.targy
+        FROM {ujbuda.db_file_detail} f
+        JOIN {ujbuda.db_folder} m ON m.folder_uuid = f.folder_uuid
+        LEFT JOIN {ujbuda.db_napirendi} n ON n.uuid = f.agenda_uuid
+        {group_filter}
+        ORDER BY group_uuid, f.uuid = group_uuid DESC, f.rowid DESC""",
+        params,
+    )
+    dates = {}
+    indexed_paths = set()
+
+    for group_uuid, group_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        txt_path = None
+        copies = {}
+        for _, folder_uuid, agenda_uuid, name, document_uuid, datum, session_name, agenda_title in group_rows:
+            if not name or not name.endswith(".pdf"):
+                continue
+            if txt_path is None:
+                # The first copy, unless its text was never extracted
+                copy_path = TXT_FOLDER / folder_uuid / agenda_uuid / name.replace(".pdf", ".txt")
+                if copy_path.is_file():
+                    txt_path = copy_path
+                    first_copy = (folder_uuid, agenda_uuid, agenda_title)
+
+            if datum not in dates:
+                try:
+                    dates[datum] = datetime.strptime(datum, '%Y.%m.%d.')
+                except (TypeError, ValueError) as e:
+                    print(e)
+                    dates[datum] = None
+            # The same file listed twice is linked under its latest uuid
+            if dates[datum] is None or (folder_uuid, agenda_uuid, name) in copies:
+                continue
+            copies[folder_uuid, agenda_uuid, name] = dict(
+                date=dates[datum],
+                session_name=session_name,
+                agenda_title=agenda_title,
+                folder_uuid=folder_uuid,
+                agenda_uuid=agenda_uuid,
+                document_uuid=document_uuid,
+                file_name=name,
+            )
+
+        # Files not fingerprinted yet may still share a txt
+        if txt_path is None or not copies or txt_path in indexed_paths:
+            continue
+        indexed_paths.add(txt_path)
+
+        copies = sorted(copies.values(), key=lambda copy: copy["date"], reverse=True)
+        folder_uuid, agenda_uuid, agenda_title = first_copy
+        yield make_index_document(txt_path,
+                                  content_analyzer,
+                                  date=copies[0]["date"],
+                                  dates=sorted({copy["date"] for copy in copies}),
+                                  session_dates=sorted({
+                                      session_date_key(copy["session_name"], copy["date"]) for copy in copies
+                                  }),
+                                  folder_uuid=folder_uuid,
+                                  agenda_uuid=agenda_uuid,
+                                  document_uuid=group_uuid,
+                                  session_name="\n".join(sorted({copy["session_name"] or "" for copy in copies})),
+                                  agenda_title=agenda_title,
+                                  copies=copies)
+
+
+def iter_index_documents(conn, folder_uuids):
+    """Yield the index documents having a copy in the given folders."""
+    return iter_group_documents(conn, folder_uuids)
+
+
+def iter_all_index_documents(conn):
+    """Yield the index documents of every stored txt file for a full rebuild.
+
+    The file, folder and agenda rows come from one joined query streamed
+    in group order instead of three queries per folder.
+    """
+    return iter_group_documents(conn)
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def write_trigram_segment(index_dir, terms):
+    """Write the trigram lookup of the given terms as the next segment file.
+
+    Layout (read by the webservice's TrigramIndex): a terms table (id,
+    term) and a trigrams table with the sorted uint32 term ids of every
+    trigram in native byte order. Segment files are never modified, so
+    hard-linked generations can share them.
+    """
+    segment_paths = sorted(index_dir.glob("trigrams-*.db"))
+    number = int(segment_paths[-1].stem.split("-")[1]) + 1 if segment_paths else 1
+    segment_path = index_dir / f"trigrams-{number:04d}.db"
+
+    postings = defaultdict(lambda: array("I"))
+    for term_id, term in enumerate(terms):
+        for gram in trigrams(term):
+            postings[gram].append(term_id)
+
+    conn = sqlite3.connect(segment_path)
     try:
-        cursor = conn.cursor()
-        columns = ", ".join(data.keys())
-        placeholders = ", ".join(["?"] * len(data))
-        values = tuple(data.values())
-        insert_query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-        cursor.execute(insert_query, values)
+        conn.execute("CREATE TABLE terms (id INTEGER PRIMARY KEY, term TEXT)")
+        conn.execute("CREATE TABLE trigrams (trigram TEXT PRIMARY KEY, term_ids BLOB) WITHOUT ROWID")
+        conn.executemany("INSERT INTO terms VALUES (?, ?)", enumerate(terms))
+        conn.executemany(
+            "INSERT INTO trigrams VALUES (?, ?)",
+            ((gram, term_ids.tobytes()) for gram, term_ids in postings.items()),
+        )
         conn.commit()
-    except sqlite3.Error as e:
-        print(e)
-        logging.error(f"Database error while inserting values {values}: {e}")
+    finally:
+        conn.close()
+    return segment_path
 
 
-logging.info(f"Env: {env}")
+def update_trigram_index(index_dir):
+    """Add the content_folded terms missing from the trigram segments of an index.
 
-os.makedirs(PDF_FOLDER, exist_ok=True)
+    Terms of deleted documents are left in place, they just find no
+    documents. Once there are TRIGRAM_MAX_SEGMENTS segments they are
+    replaced by one holding the whole lexicon.
+    """
+    start_time = time.perf_counter()
+    segment_paths = sorted(index_dir.glob("trigrams-*.db"))
+    if len(segment_paths) >= TRIGRAM_MAX_SEGMENTS:
+        for segment_path in segment_paths:
+            segment_path.unlink()
+        segment_paths = []
 
-### 1) fetch folder uuid from db
+    known_terms = set()
+    for segment_path in segment_paths:
+        conn = sqlite3.connect(f"file:{segment_path}?mode=ro", uri=True)
+        known_terms.update(term for (term,) in conn.execute("SELECT term FROM terms"))
+        conn.close()
 
-folder_df = fetch_data_from_db(DATABASE_PATH, ujbuda.db_folder)
-db_folder_uuid = folder_df["folder_uuid"]
-print(f"Len of db_folder_uuid: {len(db_folder_uuid)}")
+    # Shorter terms cannot contain a trigram
+    with index.open_dir(index_dir).reader() as reader:
+        new_terms = [
+            term for term in (btext.decode("utf8") for btext in reader.lexicon("content_folded"))
+            if len(term) >= 3 and term not in known_terms
+        ]
 
-### 2) fetch folder uuid from api
+    if new_terms:
+        segment_path = write_trigram_segment(index_dir, new_terms)
+        elapsed_time = time.perf_counter() - start_time
+        logging.info(f"Trigram index: {len(new_terms)} new terms in {segment_path.name} in {elapsed_time:.2f} s")
 
-year_url = f"{ujbuda.base_url}/inv/years"
-inv_year_r = requests.get(year_url, verify=False)
-years = inv_year_r.json()["content"]
 
-conn = sqlite3.connect(DATABASE_PATH)
-cursor = conn.cursor()
+def current_index_dir():
+    """Return the directory of the published index, or None when there is none yet."""
+    current_link = INDEX_FOLDER / "current"
+    if current_link.exists():
+        return current_link.resolve()
+    # Index written in place before generations were used
+    if index.exists_in(INDEX_FOLDER):
+        return INDEX_FOLDER
+    return None
 
-collector_df = pd.DataFrame()
 
-for year in years:
+def new_staging_dir():
+    generations_folder = INDEX_FOLDER / "generations"
+    os.makedirs(generations_folder, exist_ok=True)
+
+    # Left behind by an interrupted run
+    for name in os.listdir(generations_folder):
+        if name.startswith(".staging-"):
+            shutil.rmtree(generations_folder / name, ignore_errors=True)
+
+    staging_dir = generations_folder / f".staging-{datetime.now():%Y%m%d-%H%M%S-%f}"
+    os.makedirs(staging_dir)
+    return staging_dir
+
+
+def clone_index_dir(source_dir, target_dir):
+    """Hard link the files of an index into an empty directory.
+
+    Whoosh never rewrites its segment and TOC files, a commit adds new ones
+    and unlinks the unused ones, so the published generation is not touched
+    by writing to the clone.
+    """
+    for name in os.listdir(source_dir):
+        source_path = source_dir / name
+        if not source_path.is_file() or name.endswith("_WRITELOCK"):
+            continue
+        try:
+            os.link(source_path, target_dir / name)
+        except OSError:
+            shutil.copy2(source_path, target_dir / name)
+
+
+def validate_index(index_dir, expected_doc_count=None):
+    """Check that an index opens, holds the expected documents and answers a query."""
+    ix = index.open_dir(index_dir)
+    with ix.searcher() as searcher:
+        doc_count = searcher.doc_count()
+        if doc_count == 0:
+            raise ValueError("the index has no documents")
+        if expected_doc_count is not None and doc_count != expected_doc_count:
+            raise ValueError(f"the index has {doc_count} documents instead of {expected_doc_count}")
+
+        document_uuid = next(searcher.lexicon("document_uuid")).decode("utf8")
+        if not searcher.search(Term("document_uuid", document_uuid), limit=1):
+            raise ValueError(f"document {document_uuid} is not found")
+
+        frequent_terms = searcher.reader().most_frequent_terms("content", 1)
+        for _, term in frequent_terms:
+            if not searcher.search(Term("content", term.decode("utf8")), limit=1):
+                raise ValueError(f"the term {term!r} is not found")
+    return doc_count
+
+
+def prune_generations(keep=INDEX_GENERATIONS_KEPT):
+    generations_folder = INDEX_FOLDER / "generations"
+    current = current_index_dir()
+    names = sorted(name for name in os.listdir(generations_folder) if not name.startswith("."))
+    for name in names[:-keep] if keep else names:
+        if (generations_folder / name).resolve() != current:
+            shutil.rmtree(generations_folder / name, ignore_errors=True)
+            logging.info(f"Removed index generation {name}")
+
+
+def remove_flat_index():
+    # The in-place index is replaced by the first published generation
+    for name in os.listdir(INDEX_FOLDER):
+        path = INDEX_FOLDER / name
+        if path.is_file() and not path.is_symlink():
+            path.unlink()
+
+
+def publish_index(staging_dir, expected_doc_count=None):
+    """Validate a staged index and make it the current generation.
+
+    The staging directory is renamed into generations/ and the current
+    symlink is replaced with an atomic rename, so readers always see either
+    the previous or the new complete index. The link is relative so it also
+    resolves inside the containers. A staged index that fails validation is
+    removed and the current generation stays published.
+    """
+    try:
+        doc_count = validate_index(staging_dir, expected_doc_count)
+    except Exception as e:
+        print(f"Index validation failed, keeping the current index: {e}")
+        logging.error(f"Index validation failed, keeping the current index: {e}")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return False
+
+    generation_name = staging_dir.name.removeprefix(".staging-")
+    generation_dir = staging_dir.with_name(generation_name)
+    os.rename(staging_dir, generation_dir)
+
+    flat_index = current_index_dir() == INDEX_FOLDER
+    temp_link = INDEX_FOLDER / "current.tmp"
+    if temp_link.is_symlink():
+        temp_link.unlink()
+    os.symlink(Path("generations") / generation_name, temp_link)
+    os.replace(temp_link, INDEX_FOLDER / "current")
+
+    if flat_index:
+        remove_flat_index()
+    prune_generations()
+
+    print(f"Published index generation {generation_name} ({doc_count} documents)")
+    logging.info(f"Published index generation {generation_name} ({doc_count} documents)")
+    return True
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; the children are every process
+    # started so far, the extraction and fingerprint workers too
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def rss_since(before, after):
+    # The peaks only grow: an unchanged one was reached before the measured step
+    return f"{after:.0f} MB" if after > before else f"not above the {before:.0f} MB of earlier steps"
+
+
+def rebuild_index(conn, procs=REBUILD_PROCS, limitmb=REBUILD_LIMITMB, merge=REBUILD_MERGE):
+    """Build a new index generation from every stored txt file and publish it.
+
+    With procs > 1 the documents are analyzed by Whoosh's multiprocess
+    writer, each process using up to limitmb of memory. merge="segments"
+    keeps the segment of every process, "single" merges them at commit.
+    """
+    start_time = time.perf_counter()
+    own_rss_before, children_rss_before = peak_rss_mb()
+
+    staging_dir = new_staging_dir()
+    ix = create_in(staging_dir, build_schema())
+    if procs > 1:
+        writer = ix.writer(procs=procs, limitmb=limitmb, multisegment=merge == "segments")
+    else:
+        writer = ix.writer(limitmb=limitmb)
+    doc_count = 0
+
+    for document in iter_all_index_documents(conn):
+        writer.add_document(**document)
+        doc_count += 1
+
+    writer.commit()
+
+    elapsed_time = time.perf_counter() - start_time
+    own_rss, children_rss = peak_rss_mb()
+    with ix.reader() as reader:
+        segment_count = len(reader.leaf_readers())
+    message = (
+        f"Full rebuild: {doc_count} documents in {elapsed_time:.2f} s "
+        f"({doc_count / elapsed_time:.1f} docs/s, {procs} processes, {segment_count} segments), "
+        f"peak RSS {rss_since(own_rss_before, own_rss)}"
+    )
+    if procs > 1:
+        message += f", largest indexing process {rss_since(children_rss_before, children_rss)}"
+    print(message)
+    logging.info(message)
+
+    update_trigram_index(staging_dir)
+    publish_index(staging_dir, doc_count)
+    return doc_count
+
+
+def update_index(conn, folder_uuids):
+    """Add, update or delete the documents of the given folders only.
+
+    Documents are keyed by document_uuid. Documents of these folders that
+    no longer have a txt file are deleted. The changes are written to a
+    hard-linked clone of the current generation, which is then published;
+    when there is nothing to add or delete (e.g. the folders failed to
+    crawl) no generation is made. Falls back to a full rebuild when there
+    is no index yet or it was built with a different schema.
+    """
+    source_dir = current_index_dir()
+    if source_dir is None:
+        logging.info("No index found, rebuilding")
+        return rebuild_index(conn)
+
+    source_ix = index.open_dir(source_dir)
+    if schema_signature(source_ix.schema) != schema_signature(build_schema()):
+        logging.info("Index schema changed, rebuilding")
+        return rebuild_index(conn)
+
+    start_time = time.perf_counter()
+    with source_ix.searcher() as searcher:
+        indexed_uuids = {
+            folder_uuid: {fields["document_uuid"] for fields in searcher.documents(folder_uuid=folder_uuid)}
+            for folder_uuid in folder_uuids
+        }
+    documents = (
+        (folder_uuid, document)
+        for folder_uuid in folder_uuids
+        for document in iter_index_documents(conn, [folder_uuid])
+    )
+    first_document = next(documents, None)
+    if first_document is None and not any(indexed_uuids.values()):
+        # A new generation would make every webservice searcher reopen the index
+        print("Index unchanged, no new generation")
+        logging.info(f"Index unchanged for {len(folder_uuids)} folders, no new generation")
+        return 0
+
+    staging_dir = new_staging_dir()
+    clone_index_dir(source_dir, staging_dir)
+    writer = index.open_dir(staging_dir).writer()
+    updated_uuids = set()
+
+    if first_document is not None:
+        for folder_uuid, document in itertools.chain([first_document], documents):
+            writer.update_document(**document)
+            updated_uuids.add(document["document_uuid"])
+    doc_count = len(updated_uuids)
+
+    # A document may now be listed under another folder of the update
+    for document_uuid in set().union(*indexed_uuids.values()) - updated_uuids:
+        writer.delete_by_term("document_uuid", document_uuid)
+        logging.info(f"Removed {document_uuid} from index")
+
+    writer.commit()
+
+    elapsed_time = time.perf_counter() - start_time
+    print(f"Incremental update: {doc_count} documents in {elapsed_time:.2f} s")
+    logging.info(
+        f"Incremental update: {doc_count} documents from {len(folder_uuids)} folders in {elapsed_time:.2f} s"
+    )
+
+    update_trigram_index(staging_dir)
+    publish_index(staging_dir)
+    return doc_count
+
+
+# Columns of the inv/folders rows, in API order
+FOLDER_LIST_COLUMNS = ["datum", "nyilvanossagjelolo", "kategoria", "idopont", "hely", "folder_uuid"]
+
+
+def known_folder_uuids(conn):
+    return {row[0] for row in conn.execute(f"SELECT folder_uuid FROM {ujbuda.db_folder}")}
+
+
+def fetch_years(client):
+    year_url = f"{ujbuda.base_url}/inv/years"
+    return client.get(year_url, verify=False).json()["content"]
+
+
+def fetch_year_folders(client, year):
     folder_year_url = f"{ujbuda.base_url}/inv/folders?year={year}"
-    folder_year_response = requests.get(folder_year_url, verify=False)
-
-    folder_data = folder_year_response.json()["content"]
-    folder_df = pd.DataFrame(folder_data)
-    folder_df.columns = [
-        "datum",
-        "nyilvanossagjelolo",
-        "kategoria",
-        "idopont",
-        "hely",
-        "folder_uuid",
-    ]
+    folder_year_response = client.get(folder_year_url, verify=False)
+    return [dict(zip(FOLDER_LIST_COLUMNS, item.values())) for item in folder_year_response.json()["content"]]
 
-    collector_df = pd.concat([collector_df, folder_df], ignore_index=True)
 
-api_folder_uuid = collector_df["folder_uuid"]
+def prepare_fts_tables(conn):
+    # document_uuid -> the consecutive rowids of its pages, so a document is
+    # deleted by rowid range instead of scanning the UNINDEXED column
+    conn.execute(
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {ujbuda.db_fts} USING fts5(
+            document_uuid UNINDEXED, page UNINDEXED, content,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )"""
+    )
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {ujbuda.db_fts}_docs (
+            document_uuid TEXT PRIMARY KEY, first_rowid INTEGER NOT NULL, page_count INTEGER NOT NULL
+        )"""
+    )
 
-missing_uuid = list(set(api_folder_uuid) - set(db_folder_uuid))
-missing_df = collector_df[collector_df["folder_uuid"].isin(missing_uuid)]
 
-if env == "test":
-    print("skipping test case")
-    #logging.info("Test case 1")
-    #db_folder_uuid = db_folder_uuid.iloc[1:]
-    #missing_uuid = list(set(api_folder_uuid) - set(db_folder_uuid))
-    #missing_df = collector_df[collector_df["folder_uuid"].isin(missing_uuid)]
-
-if len(missing_df) > 0:
-    print(f"Len of missing_df: {len(missing_df)}")
-    print(missing_df)
-    logging.info(missing_df)
-else:
-    print("No new documents")
-    logging.info("No new documents")
-
-for folder_uuid in missing_df["folder_uuid"]:
+def fts_index_exists(conn):
+    cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (f"{ujbuda.db_fts}_docs",))
+    return cursor.fetchone() is not None
+
+
+def read_txt_pages(txt_path):
+    with open(txt_path, "r", encoding="utf8", errors="replace") as f:
+        pages = f.read().split("\f")
+    # The last page ends with a form feed too
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+
+def delete_fts_document(conn, document_uuid):
+    row = conn.execute(
+        f"SELECT first_rowid, page_count FROM {ujbuda.db_fts}_docs WHERE document_uuid = ?", (document_uuid,)
+    ).fetchone()
+    if row is None:
+        return
+    first_rowid, page_count = row
+    conn.execute(
+        f"DELETE FROM {ujbuda.db_fts} WHERE rowid BETWEEN ? AND ?", (first_rowid, first_rowid + page_count - 1)
+    )
+    conn.execute(f"DELETE FROM {ujbuda.db_fts}_docs WHERE document_uuid = ?", (document_uuid,))
+
+
+def write_fts_documents(conn, documents):
+    """Replace the pages of the given index documents in the FTS table."""
+    next_rowid = conn.execute(f"SELECT COALESCE(MAX(rowid), 0) + 1 FROM {ujbuda.db_fts}").fetchone()[0]
+    doc_count = 0
+    for document in documents:
+        delete_fts_document(conn, document["document_uuid"])
+        txt_path = TXT_FOLDER / document["folder_uuid"] / document["agenda_uuid"] / document["file_name"]
+        pages = read_txt_pages(txt_path)
+        # Empty pages keep their number, the webservice links to #page=N
+        conn.executemany(
+            f"INSERT INTO {ujbuda.db_fts} (rowid, document_uuid, page, content) VALUES (?, ?, ?, ?)",
+            [
+                (next_rowid + number, document["document_uuid"], number + 1, page)
+                for number, page in enumerate(pages)
+            ],
+        )
+        conn.execute(
+            f"INSERT INTO {ujbuda.db_fts}_docs (document_uuid, first_rowid, page_count) VALUES (?, ?, ?)",
+            (document["document_uuid"], next_rowid, len(pages)),
+        )
+        next_rowid += len(pages)
+        doc_count += 1
+    return doc_count
+
+
+def log_fts_size(conn):
+    try:
+        size = conn.execute(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name LIKE ?", (f"{ujbuda.db_fts}%",)
+        ).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table
+        return
+    message = f"FTS index size: {size / 1e6:.1f} MB"
+    print(message)
+    logging.info(message)
+
+
+def rebuild_fts_index(conn):
+    """Fill the FTS table from every stored txt file, in one transaction."""
+    start_time = time.perf_counter()
+    conn.commit()
+    with conn:
+        # sqlite3 only begins a transaction before DML, the drops would be
+        # committed at once and a failed rebuild would leave empty tables
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS {ujbuda.db_fts}")
+        conn.execute(f"DROP TABLE IF EXISTS {ujbuda.db_fts}_docs")
+        prepare_fts_tables(conn)
+        doc_count = write_fts_documents(conn, iter_all_index_documents(conn))
+        conn.execute(f"INSERT INTO {ujbuda.db_fts} ({ujbuda.db_fts}) VALUES ('optimize')")
+
+    elapsed_time = time.perf_counter() - start_time
+    message = f"FTS rebuild: {doc_count} documents in {elapsed_time:.2f} s"
+    print(message)
+    logging.info(message)
+    log_fts_size(conn)
+    return doc_count
+
+
+def update_fts_index(conn, folder_uuids):
+    """Replace the FTS pages of the given folders, like update_index()."""
+    if not fts_index_exists(conn):
+        return rebuild_fts_index(conn)
+
+    start_time = time.perf_counter()
+    doc_count = 0
+    with conn:
+        for folder_uuid in folder_uuids:
+            indexed_uuids = {
+                row[0]
+                for row in conn.execute(
+                    f"""SELECT d.document_uuid FROM {ujbuda.db_fts}_docs d
+                    JOIN {ujbuda.db_file_detail} f ON f.uuid = d.document_uuid
+                    WHERE f.folder_uuid = ?""",
+                    (folder_uuid,),
+                )
+            }
+            documents = list(iter_index_documents(conn, [folder_uuid]))
+            doc_count += write_fts_documents(conn, documents)
+            for document_uuid in indexed_uuids - {document["document_uuid"] for document in documents}:
+                delete_fts_document(conn, document_uuid)
+
+    elapsed_time = time.perf_counter() - start_time
+    message = f"FTS update: {doc_count} documents in {elapsed_time:.2f} s"
+    print(message)
+    logging.info(message)
+    return doc_count
+
+
+def find_missing_folders(client, pool, known_uuids, years=None):
+    """Return the folders listed by the API for the given years (default:
+    every year) whose uuid is not in `known_uuids`, as inv/folders rows.
+
+    Only the folder lists are fetched, no folder details.
+    """
+    with metrics.stage("year_discovery"):
+        if years is None:
+            years = fetch_years(client)
+        year_folders = list(pool.map(lambda year: fetch_year_folders(client, year), years))
+    metrics.count("years", len(years))
+
+    listed_count = 0
+    missing_folders = []
+    for folders in year_folders:
+        listed_count += len(folders)
+        missing_folders.extend(folder for folder in folders if folder["folder_uuid"] not in known_uuids)
+    metrics.count("folders_listed", listed_count)
+    metrics.count("folders_missing", len(missing_folders))
+
+    if missing_folders:
+        print(f"New folders: {len(missing_folders)} of {listed_count} listed for {len(years)} years")
+        for folder in missing_folders:
+            logging.info(f"New folder {folder['folder_uuid']} ({folder['datum']})")
+    else:
+        print("No new documents")
+        logging.info("No new documents")
+
+    return missing_folders
+
+
+@dataclass
+class FolderCrawl:
+    """API data fetched for one folder, stored by store_folder()."""
+
+    folder_uuid: str
+    folder_details: dict
+    agenda_items: list = field(default_factory=list)
+    # (agenda_uuid, file items) for every agenda item with files
+    agenda_files: list = field(default_factory=list)
+
+
+def crawl_folder(client, pool, folder_uuid):
+    """Fetch the details, agenda items and file lists of a folder.
+
+    The file lists of the agenda items are fetched concurrently on `pool`.
+    Returns None when the folder details are not available.
+    """
     logging.info(f"Processing folder: {folder_uuid}")
 
     # Fetch folder details
     folder_detail_url = f"{ujbuda.base_url}/detail?id={folder_uuid}"
-    folder_detail_data = fetch_json(folder_detail_url)
+    with metrics.stage("folder_details"):
+        folder_detail_data = fetch_json(client, folder_detail_url)
     if not folder_detail_data:
         logging.error(f"Failed to fetch folder details for UUID {folder_uuid}")
-        continue
+        return None
 
     folder_details = folder_detail_data.get("content", {})
     if not folder_details:
         logging.warning(f"No details found for folder UUID {folder_uuid}")
-        continue
+        return None
 
     folder_details["folder_uuid"] = folder_uuid
     folder_details["detail_uuid"] = folder_details.pop("uuid")
@@ -176,21 +1005,8 @@ for folder_uuid in missing_df["folder_uuid"]:
 
     if "nev" in folder_details:
         folder_details["name"] = folder_details.pop("nev")
-        
-    #Insert folder_details into db_folder
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT 1 FROM {ujbuda.db_folder} WHERE folder_uuid = ?", (folder_uuid,))
-        if not cursor.fetchone():
-            logging.info(f"Inserting {folder_uuid} in {ujbuda.db_folder}")
-            columns = list(folder_details.keys())
-            placeholders = ", ".join(["?"] * len(columns))
-            sql = f"INSERT INTO {ujbuda.db_folder} ({', '.join(columns)}) VALUES ({placeholders})"
-            cursor.execute(sql, tuple(folder_details[col] for col in columns))
-            conn.commit()
-        else:
-            logging.warning(f"{folder_uuid} already in {ujbuda.db_folder}")
-            print(f"{folder_uuid} already in {ujbuda.db_folder}")
+
+    folder_crawl = FolderCrawl(folder_uuid, folder_details)
 
     session_type = folder_details.get("name", "").lower()
 
@@ -201,45 +1017,26 @@ for folder_uuid in missing_df["folder_uuid"]:
         agenda_url = f"{ujbuda.base_url}/inv/listtest?id={folder_uuid}"
     else:
         logging.warning(f"Unknown session type for folder {folder_uuid}")
-        continue
+        return folder_crawl
 
     # Fetch agenda data
-    agenda_data = fetch_json(agenda_url)
+    with metrics.stage("agenda_listing"):
+        agenda_data = fetch_json(client, agenda_url)
     if not agenda_data or not agenda_data.get("content"):
         logging.info(f"No agenda data for folder {folder_uuid}")
-        continue
+        return folder_crawl
 
     for agenda_item in agenda_data["content"]:
         agenda_item["folder_uuid"] = folder_uuid
-        uuid = agenda_item.get("uuid")
-        if not uuid:
+        if not agenda_item.get("uuid"):
             logging.warning(f"Agenda item missing UUID for folder {folder_uuid}")
             continue
+        folder_crawl.agenda_items.append(agenda_item)
 
-        # Insert agenda item into the database
-        try:
-            with sqlite3.connect(DATABASE_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"SELECT 1 FROM {ujbuda.db_napirendi} WHERE uuid = ?", (uuid,)
-                )
-                if not cursor.fetchone():
-                    columns = list(agenda_item.keys())
-                    placeholders = ", ".join(["?"] * len(columns))
-                    sql = f"INSERT INTO {ujbuda.db_napirendi} ({', '.join(columns)}) VALUES ({placeholders})"
-                    cursor.execute(sql, tuple(agenda_item[col] for col in columns))
-                    conn.commit()
-        except sqlite3.DatabaseError as e:
-            logging.error(
-                f"Database error while inserting agenda item UUID {uuid}: {e}"
-            )
-            continue
-
-    # Process files for agenda items
-    for agenda_item in agenda_data["content"]:
+    def fetch_agenda_files(agenda_item):
         if agenda_item.get("napirend") == "0":
             # Skip downloading the invite
-            continue
+            return None
 
         file_name = agenda_item.get("name")
         agenda_uuid = agenda_item.get("uuid")
@@ -247,148 +1044,760 @@ for folder_uuid in missing_df["folder_uuid"]:
             logging.warning(
                 f"Missing file_name or agenda_uuid for folder {folder_uuid}"
             )
-            continue
+            return None
 
         body_dok_url = (
             f"{ujbuda.base_url}/elo/djav?uuid={folder_uuid}&uuid2={agenda_uuid}"
         )
         try:
-            body_file_json = fetch_json(body_dok_url)
+            with metrics.stage("file_listing"):
+                body_file_json = fetch_json(client, body_dok_url)
             if not body_file_json or not body_file_json.get("content"):
                 logging.warning(f"No file content for agenda {agenda_uuid}")
-                continue
+                return None
         except Exception as e:
             logging.error(f"Error fetching files for agenda UUID {agenda_uuid}: {e}")
-            continue
+            return None
 
-        # insert file
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cursor = conn.cursor()
-            for file_item in body_file_json.get("content", []):
-                file_item["folder_uuid"] = folder_uuid
-                file_item["agenda_uuid"] = agenda_uuid
-                file_uuid = file_item.get("uuid")
-                cursor.execute(
-                    f"SELECT 1 FROM {ujbuda.db_file_detail} WHERE uuid = ?",
-                    (file_uuid,),
-                )
-                if not cursor.fetchone():
-                    insert_into_table(conn, ujbuda.db_file_detail, file_item)
-                    logging.info(f"file_uuid {file_uuid} added to database")
-                else:
-                    logging.error(f"file_uuid {file_uuid} already in database")
-
-        for file_item in body_file_json.get("content", []):
-            file_name = file_item.get("name")
-            file_uuid = file_item.get("uuid")
-
-            if not file_name or not file_uuid:
-                logging.warning(f"Missing file details for agenda UUID {agenda_uuid}")
-                continue
+        return agenda_uuid, body_file_json.get("content", [])
 
-            file_download_url = f"{ujbuda.base_url}/getfile/{file_uuid}/{file_name}"
-            save_path = PDF_FOLDER / folder_uuid / agenda_uuid / file_name
+    for agenda_files in pool.map(fetch_agenda_files, agenda_data["content"]):
+        if agenda_files:
+            folder_crawl.agenda_files.append(agenda_files)
+
+    return folder_crawl
+
+
+def store_folder(conn, folder_crawl):
+    """Insert the folder, its agenda items and file details in one transaction."""
+    folder_uuid = folder_crawl.folder_uuid
+
+    file_items = []
+    for agenda_uuid, agenda_file_items in folder_crawl.agenda_files:
+        for file_item in agenda_file_items:
+            file_item["folder_uuid"] = folder_uuid
+            file_item["agenda_uuid"] = agenda_uuid
+            file_items.append(file_item)
+
+    with conn:
+        #Insert folder_details into db_folder
+        if insert_rows(conn, ujbuda.db_folder, [folder_crawl.folder_details]):
+            logging.info(f"Inserting {folder_uuid} in {ujbuda.db_folder}")
+        else:
+            logging.warning(f"{folder_uuid} already in {ujbuda.db_folder}")
+            print(f"{folder_uuid} already in {ujbuda.db_folder}")
+
+        agenda_count = insert_rows(conn, ujbuda.db_napirendi, folder_crawl.agenda_items)
+        file_count = insert_rows(conn, ujbuda.db_file_detail, file_items)
+
+    logging.info(
+        f"{folder_uuid}: {agenda_count}/{len(folder_crawl.agenda_items)} agenda items, "
+        f"{file_count}/{len(file_items)} files added to database"
+    )
+
+
+def fetch_known_files(conn, folder_uuid):
+    """Return {file uuid: (filesize, sha256, content_uuid)} of the files already stored for a folder."""
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT uuid, filesize, sha256, content_uuid FROM {ujbuda.db_file_detail} WHERE folder_uuid = ?",
+        (folder_uuid,),
+    )
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def record_downloads(conn, downloads):
+    with conn:
+        conn.executemany(
+            f"UPDATE {ujbuda.db_file_detail} SET filesize = ?, sha256 = ?, download_size = ? WHERE uuid = ?",
+            [
+                (download.filesize, download.sha256, download.size, download.file_uuid)
+                for download in downloads
+            ],
+        )
+
+
+@dataclass
+class Download:
+    """A PDF downloaded by download_file()."""
+
+    file_uuid: str
+    file_name: str
+    pdf_path: Path
+    txt_path: Path
+    # Size reported by the API
+    filesize: int
+    sha256: str
+    size: int
+    # Same content as the already extracted version
+    unchanged: bool
+
+
+def pdf_store_path(sha256):
+    """Path of a PDF in the content-addressed store, shared with the webservice."""
+    return PDF_STORE_FOLDER / sha256[:2] / f"{sha256}.pdf"
+
+
+def download_file(client, folder_uuid, agenda_uuid, file_item, known=None):
+    """Stream a PDF into the PDF store while hashing it.
+
+    `known` is the (filesize, sha256, content_uuid) already stored for this
+    file. If the size reported by the API still matches and the text is
+    stored (in its own txt or in that of another copy), nothing is
+    downloaded. Files are stored under their SHA-256, so an attachment
+    shared by several agendas is stored once. Returns a Download, or None
+    when skipped or failed.
+    """
+    file_name = file_item.get("name")
+    file_uuid = file_item.get("uuid")
+
+    if not file_name or not file_uuid:
+        logging.warning(f"Missing file details for agenda UUID {agenda_uuid}")
+        return None
+
+    file_download_url = f"{ujbuda.base_url}/getfile/{file_uuid}/{file_name}"
+    txt_path = TXT_FOLDER / folder_uuid / agenda_uuid / file_name.replace(".pdf", ".txt")
+
+    known_size, known_sha256, content_uuid = known or (None, None, None)
+    has_text = txt_path.exists() or content_uuid not in (None, file_uuid)
+    if known_sha256 and known_size == file_item.get("filesize") and has_text:
+        logging.info(f"Skipping unchanged file {file_name} for agenda {agenda_uuid}")
+        metrics.count("files_skipped")
+        return None
+
+    # Download to a temp file and move it to its hash when complete
+    part_path = PDF_STORE_FOLDER / "tmp" / f"{file_uuid}.part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with metrics.stage("download"), client.get(file_download_url, timeout=10, stream=True) as file_response:
+            file_response.raise_for_status()
+            with open(part_path, "wb") as file:
+                for chunk in file_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        client.count_bytes(size)
+        metrics.count("files_downloaded")
+        metrics.count("pdf_bytes", size)
+        logging.info(f"Downloaded file {file_name} for agenda {agenda_uuid}")
+    except requests.RequestException as e:
+        logging.error(f"Error downloading file {file_name}: {e}")
+        if part_path.exists():
+            os.remove(part_path)
+        return None
+
+    store_path = pdf_store_path(sha256.hexdigest())
+    if store_path.exists():
+        os.remove(part_path)
+        metrics.count("files_deduplicated")
+        logging.info(f"File {file_name} is already stored as {store_path.name}")
+    else:
+        os.makedirs(store_path.parent, exist_ok=True)
+        os.replace(part_path, store_path)
+
+    unchanged = sha256.hexdigest() == known_sha256 and has_text
+    return Download(
+        file_uuid,
+        file_name,
+        store_path,
+        txt_path,
+        file_item.get("filesize"),
+        sha256.hexdigest(),
+        size,
+        unchanged,
+    )
+
+
+MINHASH_PRIME = 4294967291  # largest prime below 2**32
+# Shingles hashed at once: 64 permutations x 4096 uint64 is 2 MB
+MINHASH_CHUNK = 4096
+
+
+def minhash_signature(text):
+    """MinHash signature of the SHINGLE_WORDS long word shingles of a text.
+
+    Returns MINHASH_PERMUTATIONS uint32 values as bytes, None for a text
+    without words. The share of equal values estimates the Jaccard
+    similarity of the shingle sets.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf8"), digest_size=4).digest(), "little") for shingle in shingles],
+        dtype=np.uint64,
+    )
+    # Fixed seed: the signatures stored in the database must stay comparable
+    rng = np.random.default_rng(11)
+    a = rng.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+    # a * hash + b stays below 2**64; a chunk at a time, a long text has
+    # hundreds of thousands of shingles
+    signature = np.full(MINHASH_PERMUTATIONS, MINHASH_PRIME, dtype=np.uint64)
+    for start in range(0, len(hashes), MINHASH_CHUNK):
+        chunk = hashes[start:start + MINHASH_CHUNK]
+        np.minimum(signature, ((np.outer(a, chunk) + b[:, None]) % MINHASH_PRIME).min(axis=1), out=signature)
+    return signature.astype(np.uint32).tobytes()
+
+
+def text_fingerprints(text, near_duplicates=False):
+    """Return the SHA-256 of the text with its whitespace collapsed and its MinHash (or None)."""
+    text_sha256 = hashlib.sha256(" ".join(text.split()).encode("utf8")).hexdigest()
+    return text_sha256, minhash_signature(text) if near_duplicates else None
 
-            # Download and save file
-            try:
-                file_response = requests.get(file_download_url, timeout=10)
-                file_response.raise_for_status()
-                os.makedirs(save_path.parent, exist_ok=True)
-                with open(save_path, "wb") as file:
-                    file.write(file_response.content)
-                logging.info(f"Downloaded file {file_name} for agenda {agenda_uuid}")
-            except requests.RequestException as e:
-                logging.error(f"Error downloading file {file_name}: {e}")
-                continue
 
-            # Convert to text and save
+def fingerprint_txt(txt_path, near_duplicates=False):
+    with open(txt_path, "r", encoding="utf8", errors="replace") as f:
+        return text_fingerprints(f.read(), near_duplicates)
+
+
+def extract_text(pdf_path, txt_path, near_duplicates=False):
+    """Convert a PDF to text, every page followed by a form feed.
+
+    Runs in the extraction process pool. Returns the start time of the
+    extraction (time.time()), its duration, the extraction time of every
+    page in seconds and the text_fingerprints() of the text.
+    """
+    extract_start = time.time()
+    page_times = []
+    texts = []
+    with fitz.open(pdf_path) as doc:
+        os.makedirs(txt_path.parent, exist_ok=True)
+        with open(txt_path, "wb") as out:
+            for page in doc:
+                start_time = time.perf_counter()
+                text = page.get_text()
+                page_times.append(time.perf_counter() - start_time)
+                texts.append(text)
+                out.write(text.encode("utf8"))
+                out.write(bytes((12,)))
+    return (extract_start, time.time() - extract_start, page_times) + text_fingerprints("".join(texts), near_duplicates)
+
+
+def remove_txt(txt_path):
+    for path in (txt_path, line_offsets_path(txt_path)):
+        if path.exists():
+            os.remove(path)
+
+
+def file_txt_path(conn, file_uuid):
+    row = conn.execute(
+        f"SELECT folder_uuid, agenda_uuid, name FROM {ujbuda.db_file_detail} WHERE uuid = ?", (file_uuid,)
+    ).fetchone()
+    if row is None or not row[2]:
+        return None
+    return TXT_FOLDER / row[0] / row[1] / row[2].replace(".pdf", ".txt")
+
+
+def first_pdf_copies(conn):
+    """Return {sha256: (file uuid, txt path)} of the first copy of every stored PDF."""
+    first_copies = {}
+    rows = conn.execute(
+        f"""SELECT sha256, uuid, folder_uuid, agenda_uuid, name FROM {ujbuda.db_file_detail}
+        WHERE sha256 IS NOT NULL AND (content_uuid IS NULL OR content_uuid = uuid) AND name LIKE '%.pdf'
+        ORDER BY rowid DESC"""
+    )
+    for sha256, file_uuid, folder_uuid, agenda_uuid, name in rows:
+        first_copies[sha256] = (file_uuid, TXT_FOLDER / folder_uuid / agenda_uuid / name.replace(".pdf", ".txt"))
+    return first_copies
+
+
+def assign_content_uuids(conn, fingerprints, pdf_copies=()):
+    """Point every fingerprinted file to the first file with the same text.
+
+    `fingerprints` are (file uuid, txt path, text sha256, MinHash or None)
+    in the order the first copies are chosen, `pdf_copies` are (file uuid,
+    uuid of a file with the same PDF) of files not extracted at all. With
+    NEAR_DUPLICATES a text whose MinHash is similar enough to that of a
+    first copy counts as a copy too. The txt of a copy is removed, its text
+    is searched in the txt of the first copy. Returns the number of copies.
+    """
+    table = ujbuda.db_file_detail
+    signature_uuids = []
+    signatures = np.empty((0, MINHASH_PERMUTATIONS), dtype=np.uint32)
+    if NEAR_DUPLICATES:
+        rows = conn.execute(
+            f"SELECT uuid, minhash FROM {table} WHERE content_uuid = uuid AND minhash IS NOT NULL"
+        ).fetchall()
+        signature_uuids = [row[0] for row in rows]
+        if rows:
+            signatures = np.vstack([np.frombuffer(row[1], dtype=np.uint32) for row in rows])
+
+    first_copies = {}
+    updates = []
+    copy_count = 0
+    for file_uuid, txt_path, text_sha256, minhash in fingerprints:
+        content_uuid = first_copies.get(text_sha256)
+        if content_uuid is None:
+            row = conn.execute(
+                f"SELECT uuid FROM {table} WHERE text_sha256 = ? AND content_uuid = uuid AND uuid != ? LIMIT 1",
+                (text_sha256, file_uuid),
+            ).fetchone()
+            content_uuid = row[0] if row else None
+        if content_uuid:
+            metrics.count("text_duplicates")
+        elif minhash is not None and signature_uuids:
+            similarity = (signatures == np.frombuffer(minhash, dtype=np.uint32)).mean(axis=1)
+            best = int(similarity.argmax())
+            if similarity[best] >= NEAR_DUPLICATE_THRESHOLD:
+                content_uuid = signature_uuids[best]
+                metrics.count("near_duplicates")
+                logging.info(f"{txt_path} is a near duplicate ({similarity[best]:.2f}) of {content_uuid}")
+
+        if content_uuid is None:
+            content_uuid = file_uuid
+            first_copies[text_sha256] = file_uuid
+            if minhash is not None:
+                signature_uuids.append(file_uuid)
+                signatures = np.vstack([signatures, np.frombuffer(minhash, dtype=np.uint32)])
+        else:
+            # Unless the same file is listed twice under one agenda
+            if txt_path != file_txt_path(conn, content_uuid):
+                remove_txt(txt_path)
+            copy_count += 1
+        updates.append((text_sha256, minhash, content_uuid, file_uuid))
+
+    with conn:
+        conn.executemany(
+            f"UPDATE {table} SET text_sha256 = ?, minhash = ?, content_uuid = ? WHERE uuid = ?", updates
+        )
+        conn.executemany(
+            f"""UPDATE {table} SET content_uuid = ?, minhash = NULL,
+                text_sha256 = (SELECT text_sha256 FROM {table} WHERE uuid = ?)
+            WHERE uuid = ?""",
+            [(first_uuid, first_uuid, file_uuid) for file_uuid, first_uuid in pdf_copies],
+        )
+        resolve_content_uuid_chains(conn)
+    return copy_count + len(pdf_copies)
+
+
+def resolve_content_uuid_chains(conn):
+    """Point the copies of a file that turned out to be a copy itself to
+    its first copy.
+
+    Chains forming a cycle (e.g. after a manual edit) cannot be resolved,
+    their rows are left as they are and logged.
+    """
+    table = ujbuda.db_file_detail
+    copies = dict(conn.execute(f"SELECT uuid, content_uuid FROM {table} WHERE content_uuid != uuid"))
+    updates = []
+    unresolved = []
+    for file_uuid, content_uuid in copies.items():
+        seen = {file_uuid}
+        first_uuid = content_uuid
+        while first_uuid in copies:
+            if first_uuid in seen:
+                first_uuid = None
+                break
+            seen.add(first_uuid)
+            first_uuid = copies[first_uuid]
+        if first_uuid is None:
+            unresolved.append(file_uuid)
+        elif first_uuid != content_uuid:
+            updates.append((first_uuid, file_uuid))
+    conn.executemany(f"UPDATE {table} SET content_uuid = ? WHERE uuid = ?", updates)
+    if unresolved:
+        message = f"The content_uuid of {len(unresolved)} files leads into a cycle, left unresolved: {', '.join(unresolved)}"
+        print(message)
+        logging.warning(message)
+
+
+def fingerprint_stored_texts(conn, extract_workers=EXTRACT_WORKERS):
+    """Fingerprint the stored txt files that are not yet, e.g. of earlier versions.
+
+    Run before a full rebuild, so the copies among them are merged and
+    their txt files removed. Files listed twice under the same agenda
+    share the txt of the latest one.
+    """
+    start_time = time.perf_counter()
+    rows = conn.execute(
+        f"""SELECT uuid, folder_uuid, agenda_uuid, name FROM {ujbuda.db_file_detail}
+        WHERE content_uuid IS NULL AND name LIKE '%.pdf' ORDER BY rowid DESC"""
+    ).fetchall()
+    pending = {}
+    same_path = []
+    for file_uuid, folder_uuid, agenda_uuid, name in rows:
+        txt_path = TXT_FOLDER / folder_uuid / agenda_uuid / name.replace(".pdf", ".txt")
+        if txt_path in pending:
+            same_path.append((file_uuid, pending[txt_path]))
+        elif txt_path.is_file():
+            pending[txt_path] = file_uuid
+    if not pending:
+        return 0
+
+    # Oldest first, so the first copy is the one stored first
+    pending = list(pending.items())[::-1]
+    with ProcessPoolExecutor(extract_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = pool.map(
+            fingerprint_txt, [txt_path for txt_path, _ in pending], itertools.repeat(NEAR_DUPLICATES), chunksize=64
+        )
+        fingerprints = [
+            (file_uuid, txt_path) + result for (txt_path, file_uuid), result in zip(pending, results)
+        ]
+    copy_count = assign_content_uuids(conn, fingerprints, same_path)
+
+    elapsed_time = time.perf_counter() - start_time
+    message = f"Fingerprinted {len(fingerprints)} stored texts in {elapsed_time:.2f} s, {copy_count} copies merged"
+    print(message)
+    logging.info(message)
+    return copy_count
+
+
+def crawl_folders(client, conn, folder_uuids, extract_workers=EXTRACT_WORKERS):
+    """Crawl the given folders, store them, download and convert their new files.
+
+    Folders are crawled concurrently; their database writes stay on the
+    calling thread. Requests go through `client`, which bounds the
+    concurrency and rate per host. Every finished download is queued to a
+    process pool that converts the PDF to text, so extraction overlaps
+    with the network I/O and uses `extract_workers` cores.
+    """
+    downloads = []
+    extractions = {}
+    # A PDF already stored under another uuid is not extracted again
+    first_copies = first_pdf_copies(conn)
+    queued_uuids = set()
+    pdf_copies = []
+    copies_lock = threading.Lock()
+
+    # spawn: forking next to the running request threads could copy held locks
+    with ProcessPoolExecutor(
+        extract_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as extract_pool:
+
+        def queue_extraction(future):
+            download = future.result()
+            if download is None:
+                return
+            downloads.append(download)
+            if download.unchanged:
+                logging.info(f"{download.file_name} did not change, skipping text extraction")
+                return
+            with copies_lock:
+                first_uuid, first_txt_path = first_copies.get(download.sha256, (None, None))
+                if first_uuid in (None, download.file_uuid) or not (
+                    first_uuid in queued_uuids or first_txt_path.exists()
+                ):
+                    first_copies[download.sha256] = (download.file_uuid, download.txt_path)
+                    queued_uuids.add(download.file_uuid)
+                    first_uuid = None
+            if first_uuid:
+                logging.info(f"{download.file_name} is a copy of {first_uuid}, skipping text extraction")
+                metrics.count("pdf_duplicates")
+                pdf_copies.append((download.file_uuid, first_uuid))
+                if download.txt_path != first_txt_path:
+                    remove_txt(download.txt_path)
+                return
+            extraction = extract_pool.submit(extract_text, download.pdf_path, download.txt_path, NEAR_DUPLICATES)
+            extractions[extraction] = (download.file_name, download.txt_path, download.file_uuid)
+
+        with ThreadPoolExecutor(FOLDER_WORKERS) as folder_pool, ThreadPoolExecutor(
+            client.max_connections
+        ) as request_pool:
+            folder_crawls = [
+                folder_pool.submit(crawl_folder, client, request_pool, folder_uuid)
+                for folder_uuid in folder_uuids
+            ]
+
+            for future in as_completed(folder_crawls):
+                folder_crawl = future.result()
+                if folder_crawl is None:
+                    metrics.count("folders_failed")
+                    continue
+                metrics.count("folders_crawled")
+
+                with metrics.stage("db_writes"):
+                    known_files = fetch_known_files(conn, folder_crawl.folder_uuid)
+                    store_folder(conn, folder_crawl)
+
+                for agenda_uuid, file_items in folder_crawl.agenda_files:
+                    for file_item in file_items:
+                        request_pool.submit(
+                            download_file,
+                            client,
+                            folder_crawl.folder_uuid,
+                            agenda_uuid,
+                            file_item,
+                            known_files.get(file_item.get("uuid")),
+                        ).add_done_callback(queue_extraction)
+
+        with metrics.stage("db_writes"):
+            record_downloads(conn, downloads)
+
+        # The request pool has finished, so every download is queued by now
+        page_count = 0
+        page_time = 0.0
+        slowest_page = (0.0, None)
+        fingerprints = []
+
+        for future in as_completed(extractions):
+            file_name, txt_path, file_uuid = extractions[future]
             try:
-                with fitz.open(save_path) as doc:
-                    txt_path = (
-                        TXT_FOLDER
-                        / folder_uuid
-                        / agenda_uuid
-                        / file_name.replace(".pdf", ".txt")
-                    )
-                    os.makedirs(txt_path.parent, exist_ok=True)
-                    with open(txt_path, "wb") as out:
-                        for page in doc:
-                            text = page.get_text().encode("utf8")
-                            out.write(text)
-                            out.write(bytes((12,)))
-                    logging.info(f"Converted PDF to text: {txt_path}")
+                start_time, elapsed_time, page_times, text_sha256, minhash = future.result()
             except Exception as e:
                 logging.error(f"Error converting file {file_name} to text: {e}")
+                continue
+            fingerprints.append((file_uuid, txt_path, text_sha256, minhash))
+
+            logging.info(
+                f"Converted PDF to text: {txt_path} ({len(page_times)} pages in {sum(page_times):.2f} s)"
+            )
+            page_count += len(page_times)
+            page_time += sum(page_times)
+            # Timed in the extraction process
+            metrics.add_span("pdf_extraction", elapsed_time, start_time)
+            metrics.count("files_extracted")
+            metrics.count("pages_extracted", len(page_times))
+            if page_times and max(page_times) > slowest_page[0]:
+                slowest_page = (max(page_times), txt_path)
+
+        with metrics.stage("db_writes"):
+            copy_count = assign_content_uuids(conn, fingerprints, pdf_copies)
+        if copy_count:
+            message = f"Duplicates: {copy_count} files share the text of another file"
+            print(message)
+            logging.info(message)
 
-# Clean up pdf folder
-shutil.rmtree(PDF_FOLDER)
+    if page_count:
+        message = (
+            f"Extraction: {len(extractions)} files, {page_count} pages, "
+            f"{page_time / page_count * 1000:.1f} ms/page on average, "
+            f"slowest page {slowest_page[0]:.2f} s in {slowest_page[1]}"
+        )
+        print(message)
+        logging.info(message)
 
-# Reindex
-if len(missing_df) > 0:
-    print("Reindexing")
 
-    if INDEX_FOLDER.exists() and INDEX_FOLDER.is_dir():
-        shutil.rmtree(INDEX_FOLDER)
+def acquire_run_lock():
+    """Return the locked lock file, or None when another updater holds it.
 
-    os.makedirs(INDEX_FOLDER, exist_ok=True)
+    The lock is released by the OS when the process exits, also on a crash.
+    """
+    lock_file = open(LOCK_PATH, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    lock_file.truncate(0)
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    return lock_file
 
-    schema = Schema(file_name=TEXT(stored=True),
-                    date=DATETIME(stored=True,sortable=True),
-                    folder_uuid=ID(stored=True),
-                    agenda_uuid=ID(stored=True),
-                    document_uuid=ID(stored=True),
-                    content=TEXT)
 
-    ix = create_in(INDEX_FOLDER, schema)
+def year_poll_interval(year):
+    current_year = datetime.now().year
+    if int(year) >= current_year:
+        return POLL_INTERVAL_CURRENT_YEAR
+    if int(year) == current_year - 1:
+        return POLL_INTERVAL_PREVIOUS_YEAR
+    return POLL_INTERVAL_CLOSED_YEARS or float("inf")
 
-    writer = ix.writer()
 
-    for folder_uuid in os.listdir(TXT_FOLDER):
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute(f"""SELECT datum 
-            FROM {ujbuda.db_folder} 
-            WHERE folder_uuid='{folder_uuid}'
-            """)
-            folder_details = cur.fetchone()
-            try:
-                date = datetime.strptime(folder_details[0],'%Y.%m.%d.') 
-            except TypeError as te:
-                print(te)
+def update_folders(client, conn, folder_uuids, args, rebuild=False):
+    """Crawl the given folders and update (or rebuild) the index."""
+    crawl_folders(client, conn, folder_uuids, args.extract_workers)
+    client.log_throughput()
+
+    if rebuild:
+        with metrics.stage("fingerprinting"):
+            fingerprint_stored_texts(conn, args.extract_workers)
+
+    # Reindex
+    with metrics.stage("indexing"):
+        if rebuild:
+            print("Reindexing")
+            doc_count = rebuild_index(conn, args.rebuild_procs, args.rebuild_limitmb, args.rebuild_merge)
+            metrics.count("documents_indexed", doc_count)
+        elif folder_uuids:
+            print("Updating index")
+            doc_count = update_index(conn, folder_uuids)
+            metrics.count("documents_indexed", doc_count)
+
+    if FTS_INDEX and (rebuild or folder_uuids or not fts_index_exists(conn)):
+        with metrics.stage("fts_indexing"):
+            if rebuild or not fts_index_exists(conn):
+                rebuild_fts_index(conn)
+            else:
+                update_fts_index(conn, folder_uuids)
+
+
+def write_metrics(client):
+    metrics.success = bool(metrics.success)
+    metrics.count("http_requests", client.request_count)
+    metrics.count("http_retries", client.retry_count)
+    metrics.count("http_bytes", client.byte_count)
+    if client.cache:
+        metrics.count("http_cache_hits", client.cache.hit_count)
+        metrics.count("http_cache_revalidated", client.cache.revalidated_count)
+    metrics.log_summary(metrics.write(METRICS_FOLDER, METRICS_RUNS_KEPT))
+
+
+def run_once(client, conn, pool, args):
+    """Check every year for new folders, crawl and index them."""
+    metrics.reset()
+    client.reset_counters()
+    try:
+        missing_folders = find_missing_folders(client, pool, known_folder_uuids(conn))
+        update_folders(
+            client, conn, [folder["folder_uuid"] for folder in missing_folders], args, rebuild=args.rebuild
+        )
+        metrics.success = True
+    finally:
+        write_metrics(client)
+
+
+def run_daemon(client, conn, pool, args):
+    """Poll the folder lists and update when new folders appear, until stopped.
+
+    Starts with a full pass over every year. Afterwards each year is polled
+    on its own schedule (see year_poll_interval), diffing its folder list
+    against the known folder uuids kept in memory; folder details are only
+    fetched for new folders. An idle poll costs one request per due year,
+    and no metrics are written for it.
+    """
+    run_once(client, conn, pool, args)
+    known_uuids = known_folder_uuids(conn)
+
+    now = time.monotonic()
+    years = fetch_years(client)
+    next_years_poll = now + YEARS_POLL_INTERVAL
+    next_polls = {year: now + year_poll_interval(year) for year in years}
+
+    while True:
+        time.sleep(max(1.0, min([next_years_poll] + list(next_polls.values())) - time.monotonic()))
+        now = time.monotonic()
+
+        metrics.reset()
+        client.reset_counters()
+        due_years = []
+        try:
+            if now >= next_years_poll:
+                years = fetch_years(client)
+                next_years_poll = now + YEARS_POLL_INTERVAL
+            due_years = [year for year in years if next_polls.get(year, 0) <= now]
+            if not due_years:
                 continue
 
-            for agenda_uuid in os.listdir(TXT_FOLDER/folder_uuid):
-
-                for file in os.listdir(TXT_FOLDER/folder_uuid/agenda_uuid):
-                    
-                    with sqlite3.connect(DATABASE_PATH) as conn:
-                        cur = conn.cursor()
-                        try:
-                            cur.execute(f"""SELECT uuid 
-                            FROM {ujbuda.db_file_detail} 
-                            WHERE 
-                            folder_uuid = '{folder_uuid}'
-                            AND agenda_uuid = '{agenda_uuid}'
-                            AND name = '{file.replace("txt","pdf")}'
-                            """)
-                        except Exception as e:
-                            print(e)
-                            continue
-                        try:
-                            document_uuid = cur.fetchone()[0]
-                        except Exception as e:
-                            print(e)
-                            continue
-
-                    with open(TXT_FOLDER/folder_uuid/agenda_uuid/file,"r") as f:
-                        content = " ".join([i.strip().replace("/n","") for i in f.readlines() if i.strip()])
-        
-                    writer.add_document(file_name=file,
-                                        date=date,
-                                        folder_uuid=folder_uuid,
-                                        agenda_uuid=agenda_uuid,
-                                        content=content,
-                                        document_uuid=document_uuid
-                                       )                        
+            for year in due_years:
+                next_polls[year] = now + year_poll_interval(year)
+            missing_folders = find_missing_folders(client, pool, known_uuids, due_years)
+            if not missing_folders:
+                continue
 
-    writer.commit()
+            try:
+                update_folders(client, conn, [folder["folder_uuid"] for folder in missing_folders], args)
+                metrics.success = True
+            finally:
+                write_metrics(client)
+                # Folders that failed are not stored, so they are retried at the next poll
+                known_uuids = known_folder_uuids(conn)
+        except Exception as e:
+            logging.exception(f"Update failed, retrying at the next poll: {e}")
+            print(f"Update failed: {e}")
+            for year in due_years:
+                next_polls[year] = min(next_polls[year], now + POLL_INTERVAL_CURRENT_YEAR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XI-Files updater")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="rebuild the whole index instead of updating the new folders only",
+    )
+    parser.add_argument(
+        "--rebuild-procs",
+        type=int,
+        default=REBUILD_PROCS,
+        help="number of indexing processes of a full rebuild",
+    )
+    parser.add_argument(
+        "--rebuild-limitmb",
+        type=int,
+        default=REBUILD_LIMITMB,
+        help="memory limit of each indexing process in MB",
+    )
+    parser.add_argument(
+        "--rebuild-merge",
+        choices=["single", "segments"],
+        default=REBUILD_MERGE,
+        help="merge the segments of the indexing processes into one (single) or keep them (segments)",
+    )
+    parser.add_argument(
+        "--extract-workers",
+        type=int,
+        default=EXTRACT_WORKERS,
+        help="number of processes converting PDFs to text",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and poll the API for new folders instead of a single run",
+    )
+    parser.add_argument(
+        "--http-cache",
+        choices=HTTP_CACHE_MODES,
+        default=HTTP_CACHE_MODE,
+        help="API response cache: off, cache (TTL and conditional requests), record or replay a capture",
+    )
+    parser.add_argument(
+        "--http-cache-folder",
+        type=Path,
+        default=HTTP_CACHE_FOLDER,
+        help="folder of the cache, or of the capture to record or replay",
+    )
+    args = parser.parse_args()
+
+    # Configured here so the module can be imported (e.g. by the benchmark) from any directory
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        filename=LOG_FILE_PATH,
+        filemode="a",
+    )
+    logging.getLogger().addHandler(LevelCounter(metrics))
+    logging.info(f"Env: {env}")
+
+    # A run started by cron while the previous one (or the daemon) is still running exits here
+    lock_file = acquire_run_lock()
+    if lock_file is None:
+        print("Another updater is running, exiting")
+        return
+
+    # Partial downloads of an interrupted run
+    shutil.rmtree(PDF_STORE_FOLDER / "tmp", ignore_errors=True)
+    os.makedirs(PDF_STORE_FOLDER / "tmp")
+    prepare_database_folder()
+    conn = open_database()
+    share_database()
+
+    if args.http_cache in ("cache", "record"):
+        # The ZIP Letöltő of the webservice adds entries too; the cache
+        # keeps the group and mode of the folders and files it creates
+        args.http_cache_folder.mkdir(parents=True, exist_ok=True)
+        share_path(args.http_cache_folder, 0o2775)
+    client = HttpClient(
+        max_connections=HTTP_CONNECTIONS,
+        requests_per_second=HTTP_REQUESTS_PER_SECOND,
+        retries=HTTP_RETRIES,
+        cache=HttpCache(args.http_cache_folder, HTTP_CACHE_TTLS, args.http_cache),
+    )
+
+    try:
+        with ThreadPoolExecutor(client.max_connections) as pool:
+            if args.daemon:
+                logging.info("Starting in daemon mode")
+                run_daemon(client, conn, pool, args)
+            else:
+                run_once(client, conn, pool, args)
+    finally:
+        client.close()
+        conn.close()
+        lock_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+JSON kereső API a Streamlit felület nélkül
+"""
+import argparse
+import datetime
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from backends import QueryError, SearchRequest
+from search import ResultCache
+from store import DataStore
+
+DATABASE_PATH = Path("./data/db/onkorm.db")
+TXT_FOLDER = Path("./data/txt")
+INDEX_FOLDER = Path("./data/whoosh_index_dir")
+
+# "whoosh": the index in INDEX_FOLDER, "fts5": the FTS5 table the updater fills in onkorm.db
+SEARCH_BACKEND = "whoosh"
+FTS_ORDER = "date"  # "date": newest first, "rank": best bm25 rank first
+
+# Matching pages returned with a snippet per hit
+SNIPPET_PAGES = 3
+
+API_HOST = "0.0.0.0"
+API_PORT = 8520
+API_WORKERS = 16  # request threads, each keeps its searcher open
+API_KEEPALIVE_TIMEOUT = 5  # seconds an idle keep-alive connection may hold a thread
+API_TIME_LIMIT = 10.0  # seconds per search; the hits found by then are returned with "partial": true
+API_MAX_PAGE_SIZE = 100
+
+# Resolved result pages kept in memory
+RESULT_CACHE_ENTRIES = 1024
+RESULT_CACHE_BYTES = 128 * 1024 * 1024
+
+@dataclass
+class Onkorm:
+    """Dataclass to store configuration for Onkorm."""
+    name: str
+    base_url: str
+    db_folder: str
+    db_napirendi: str
+    db_file_detail: str
+    db_fts: str
+
+
+ujbuda = Onkorm(
+    name="Újbuda",
+    base_url="https://mikrodat.ujbuda.hu/app/cms/api/honlap",
+    db_folder="ujbuda_meghivo_mappa",
+    db_napirendi="ujbuda_napirendi",
+    db_file_detail="ujbuda_file_det",
+    db_fts="ujbuda_fts",
+)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def parse_search_request(query_string):
+    """Build the SearchRequest of a /search query string.
+
+    q: search text; exact, regex: 1/true/yes; session: a session name,
+    repeated for several (none means every session); from, to: inclusive
+    YYYY-MM-DD dates; page, page_size; timelimit: seconds, at most
+    API_TIME_LIMIT. Returns (request, time limit).
+    """
+    params = parse_qs(query_string)
+
+    def first(name, default=None):
+        values = params.get(name)
+        return values[-1] if values else default
+
+    def flag(name):
+        return first(name, "0").lower() in ("1", "true", "yes")
+
+    def date(name, end_of_day):
+        value = first(name)
+        if not value:
+            return None
+        try:
+            day = datetime.date.fromisoformat(value)
+        except ValueError:
+            raise BadRequest(f"{name}: expected YYYY-MM-DD, got {value!r}")
+        return datetime.datetime.combine(day, datetime.time.max if end_of_day else datetime.time.min)
+
+    def number(name, default, type_=int):
+        try:
+            return type_(first(name, default))
+        except ValueError:
+            raise BadRequest(f"{name}: expected a number, got {first(name)!r}")
+
+    search_text = first("q", "").strip()
+    if not search_text:
+        raise BadRequest("q: missing search text")
+    page_size = number("page_size", 20)
+    if not 1 <= page_size <= API_MAX_PAGE_SIZE:
+        raise BadRequest(f"page_size: must be between 1 and {API_MAX_PAGE_SIZE}")
+    # Capped, never off: regex searches would otherwise hold a pool thread without limit
+    time_limit = number("timelimit", API_TIME_LIMIT, float)
+    if not math.isfinite(time_limit) or time_limit <= 0:
+        raise BadRequest(f"timelimit: must be a positive number of seconds, got {first('timelimit')!r}")
+    time_limit = min(time_limit, API_TIME_LIMIT)
+
+    request = SearchRequest(
+        search_text,
+        flag("exact"),
+        flag("regex"),
+        session_names=tuple(params["session"]) if "session" in params else None,
+        date_from=date("from", False),
+        date_to=date("to", True),
+        pagenum=max(1, number("page", 1)),
+        pagelen=page_size,
+    )
+    return request, time_limit
+
+
+def copy_json(copy, store):
+    # Indexes built before the metadata was stored fall back to the tables
+    session_name = copy["session_name"] or store.mappa_by_uuid.get(copy["folder_uuid"], {}).get("name")
+    agenda_title = copy["agenda_title"] or store.napi_by_uuid.get(copy["agenda_uuid"], {}).get("targy")
+    return {
+        "session_name": session_name,
+        "agenda_title": agenda_title,
+        "date": copy["date"].date().isoformat(),
+        "folder_uuid": copy["folder_uuid"],
+        "agenda_uuid": copy["agenda_uuid"],
+        "document_uuid": copy["document_uuid"],
+        "file_name": copy["file_name"],
+        "document_url": f"{ujbuda.base_url}/getfile/{copy['document_uuid']}/{copy['file_name']}",
+        "invitation_url": f"https://mikrodat.ujbuda.hu/web/inv/{copy['folder_uuid']}",
+    }
+
+
+def page_json(page, request, store):
+    return {
+        "total": page["total"],
+        "total_files": page["total_files"],
+        "page": page["pagenum"],
+        "page_count": page["pagecount"],
+        "page_size": request.pagelen,
+        "partial": page["partial"],
+        "hits": [
+            dict(
+                copy_json(hit, store),
+                pages=hit["pages"],
+                snippets=[{"page": number, "text": text} for number, text in hit["snippets"]],
+                copies=[copy_json(copy, store) for copy in hit.get("copies") or [hit]],
+            )
+            for hit in page["hits"]
+        ],
+    }
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer handling the connections on a fixed pool of threads.
+
+    Unlike ThreadingHTTPServer, which starts a thread per connection, the
+    threads live as long as the server, so their searchers stay open. A
+    keep-alive connection holds its thread until it is closed or idle for
+    API_KEEPALIVE_TIMEOUT seconds.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, store, workers=API_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.store = store
+        self.result_cache = ResultCache(max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_BYTES)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="api")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """GET /search and GET /health, JSON responses with latency headers.
+
+    Server-Timing holds the time spent checking for a new index
+    generation (refresh), searching (search) and in total in ms, X-Cache
+    whether the page came from the result cache.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = API_KEEPALIVE_TIMEOUT
+    quiet = False
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        url = urlsplit(self.path)
+        # Filled by the endpoint: (name, ms) pairs and the result cache status
+        self.timings = []
+        self.cache_status = None
+        try:
+            if url.path == "/search":
+                status, payload = self.search(url.query)
+            elif url.path == "/health":
+                status, payload = self.health()
+            else:
+                status, payload = 404, {"error": f"Unknown path {url.path}"}
+        except Exception as e:
+            self.log_error("Error handling %s: %r", self.path, e)
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+
+        body = json.dumps(payload, ensure_ascii=False).encode("utf8")
+        total_ms = (time.perf_counter() - start_time) * 1000
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(
+            "Server-Timing", ", ".join(f"{name};dur={ms:.2f}" for name, ms in self.timings + [("total", total_ms)])
+        )
+        self.send_header("X-Response-Time", f"{total_ms:.2f}ms")
+        if self.cache_status:
+            self.send_header("X-Cache", self.cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def search(self, query_string):
+        store = self.server.store
+        result_cache = self.server.result_cache
+        try:
+            request, time_limit = parse_search_request(query_string)
+        except BadRequest as e:
+            return 400, {"error": str(e)}
+
+        start_time = time.perf_counter()
+        backend, generation = store.refresh()
+        refresh_ms = (time.perf_counter() - start_time) * 1000
+
+        start_time = time.perf_counter()
+        try:
+            cache_key = backend.cache_key(request)
+            page = result_cache.get(cache_key, generation)
+            self.cache_status = "miss" if page is None else "hit"
+            if page is None:
+                page = backend.search(request, time_limit)
+                if not page["partial"]:
+                    result_cache.put(cache_key, generation, page)
+        except QueryError as e:
+            return 400, {"error": str(e)}
+        self.timings = [("refresh", refresh_ms), ("search", (time.perf_counter() - start_time) * 1000)]
+        return 200, page_json(page, request, store)
+
+    def health(self):
+        store = self.server.store
+        result_cache = self.server.result_cache
+        store.refresh()
+        return 200, {
+            "backend": store.backend.name,
+            "index_generation": str(store.index_dir) if store.index_dir else None,
+            "result_cache": {"entries": len(result_cache.entries), "hits": result_cache.hits, "misses": result_cache.misses},
+        }
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XI-Files JSON search API")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="request threads")
+    parser.add_argument("--backend", choices=["whoosh", "fts5"], default=SEARCH_BACKEND)
+    parser.add_argument("--quiet", action="store_true", help="do not log every request, e.g. for load tests")
+    args = parser.parse_args()
+
+    store = DataStore(
+        DATABASE_PATH,
+        TXT_FOLDER,
+        INDEX_FOLDER,
+        backend_name=args.backend,
+        snippet_pages=SNIPPET_PAGES,
+        fts_order=FTS_ORDER,
+        persistent=True,
+        fts_table=ujbuda.db_fts,
+        db_folder=ujbuda.db_folder,
+        db_napirendi=ujbuda.db_napirendi,
+        db_file_detail=ujbuda.db_file_detail,
+    )
+    SearchHandler.quiet = args.quiet
+    server = PooledHTTPServer((args.host, args.port), SearchHandler, store, args.workers)
+    print(f"Serving the {args.backend} backend on http://{args.host}:{args.port} with {args.workers} threads")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,68 @@
 Indexelt keresés
 """
 import datetime
-import io
+import hashlib
+import json
 import os
-import re
 import requests
 import shutil
-import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
-import pandas as pd
 import streamlit as st
-from whoosh import index
-from whoosh.qparser import QueryParser
-from whoosh.query import Regex
+
+from backends import QueryError, SearchRequest
+from search import ResultCache
+from store import DataStore, fetch_data_from_db
+
+# http_cache.py is shared with the updater; the image has it next to this file
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from http_cache import CachedSession, HttpCache  # noqa: E402
 
 st.set_page_config(page_title="XI Dokumentum kereső")
 
-DATABASE_PATH = Path("./data/onkorm.db")
+DATABASE_PATH = Path("./data/db/onkorm.db")
 TXT_FOLDER = Path("./data/txt")
 INDEX_FOLDER = Path("./data/whoosh_index_dir")
 DOWNLOAD_FOLDER = Path("./downloads")
-
-ix = index.open_dir(INDEX_FOLDER)
+# Filled by the updater, PDFs stored under their SHA-256
+PDF_STORE_FOLDER = Path("./data/pdf_store")
+# Finished session ZIPs, named after the folder and a hash of its file list
+ZIP_CACHE_FOLDER = DOWNLOAD_FOLDER / "zip_cache"
+ZIP_CACHE_MAX_FILES = 50
+ZIP_DOWNLOAD_WORKERS = 8
+ZIP_SPOOL_MAX_SIZE = 16 * 1024 * 1024  # downloads kept in memory up to this size
+
+# API response cache, shared with the updater (see http_cache.py); "replay" serves a capture offline
+HTTP_CACHE_FOLDER = Path("./data/http_cache")
+HTTP_CACHE_MODE = "cache"
+HTTP_CACHE_TTLS = {  # seconds per endpoint class; 0: revalidate every time, None: not cached
+    "years": 24 * 60 * 60,
+    "folders": 5 * 60,  # fetched on every rerun of the ZIP page
+    "detail": 24 * 60 * 60,
+    # The ZIP cache key is built from these lists, a change must show up
+    # before a cached ZIP is served again; a 304 still spares the body
+    "agenda": 0,
+    "files": 0,
+    "getfile": None,
+    "other": None,
+}
+
+# "whoosh": the index in INDEX_FOLDER, "fts5": the FTS5 table the updater fills in onkorm.db
+SEARCH_BACKEND = "whoosh"
+FTS_ORDER = "date"  # "date": newest first, "rank": best bm25 rank first
+
+# Matching pages shown with a snippet per hit
+SNIPPET_PAGES = 3
+
+# Resolved result pages kept in memory, shared by every session
+RESULT_CACHE_ENTRIES = 256
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
 
 @dataclass
 class Onkorm:
@@ -35,6 +73,7 @@ class Onkorm:
     db_folder: str
     db_napirendi: str
     db_file_detail: str
+    db_fts: str
 
 
 ujbuda = Onkorm(
@@ -43,24 +82,156 @@ ujbuda = Onkorm(
     db_folder="ujbuda_meghivo_mappa",
     db_napirendi="ujbuda_napirendi",
     db_file_detail="ujbuda_file_det",
+    db_fts="ujbuda_fts",
 )
 
 
-# Fetch Data
-def fetch_data_from_db(database_path, query):
-    with sqlite3.connect(database_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+@st.cache_resource
+def get_api_session():
+    # One keep-alive session for every rerun and user
+    return CachedSession(HttpCache(HTTP_CACHE_FOLDER, HTTP_CACHE_TTLS, HTTP_CACHE_MODE))
+
+
+@st.cache_resource
+def get_data_store():
+    return DataStore(
+        DATABASE_PATH,
+        TXT_FOLDER,
+        INDEX_FOLDER,
+        backend_name=SEARCH_BACKEND,
+        snippet_pages=SNIPPET_PAGES,
+        fts_order=FTS_ORDER,
+        fts_table=ujbuda.db_fts,
+        db_folder=ujbuda.db_folder,
+        db_napirendi=ujbuda.db_napirendi,
+        db_file_detail=ujbuda.db_file_detail,
+    )
+
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_BYTES)
+
+
+store = get_data_store()
+backend, generation = store.refresh()
+mappa_by_uuid = store.mappa_by_uuid
+napi_by_uuid = store.napi_by_uuid
+result_cache = get_result_cache()
+
+
+def stored_pdf_path(file_row, file_item):
+    """Return the PDF store path of a file_det row, or None when it is not stored.
+
+    The stored copy is only used while the API still reports the size and
+    modification date it had when the updater downloaded it; a file
+    replaced with one of the same size has a new dateLastModified.
+    """
+    if not file_row or not file_row["sha256"]:
+        return None
+    stored_version = (file_row["filesize"], file_row["dateLastModified"])
+    if stored_version != (file_item.get("filesize"), file_item.get("dateLastModified")):
+        return None
+    sha256 = file_row["sha256"]
+    path = PDF_STORE_FOLDER / sha256[:2] / f"{sha256}.pdf"
+    return path if path.exists() else None
 
 
-mappa_query = "SELECT * FROM ujbuda_meghivo_mappa"
-napi_query = "SELECT * FROM ujbuda_napirendi"
+def zip_cache_path(folder_uuid, file_items):
+    # Any added, removed or modified file gives a new name
+    file_list = sorted(
+        (item.get("uuid") or "", item.get("name") or "", item.get("dateLastModified") or "", item.get("filesize") or 0)
+        for item in file_items
+    )
+    key = hashlib.sha256(json.dumps(file_list).encode("utf8")).hexdigest()[:16]
+    return ZIP_CACHE_FOLDER / f"{folder_uuid}-{key}.zip"
+
+
+def prune_zip_cache(zip_path, folder_uuid):
+    for old_path in ZIP_CACHE_FOLDER.glob(f"{folder_uuid}-*.zip"):
+        if old_path != zip_path:
+            old_path.unlink(missing_ok=True)
+    cached = sorted(ZIP_CACHE_FOLDER.glob("*.zip"), key=lambda path: path.stat().st_mtime)
+    for old_path in cached[:-ZIP_CACHE_MAX_FILES]:
+        old_path.unlink(missing_ok=True)
+
+
+def build_session_zip(session, folder_uuid, file_items, zip_path):
+    """Write the files of a session into a ZIP, reading the PDF store first.
+
+    Missing files are downloaded concurrently into spooled temp files and
+    copied into the archive in list order, no staging folder is used. PDFs
+    are stored, they do not compress. The archive is only moved to
+    zip_path when every file was added. Returns (path of the archive,
+    number of stored files, number of downloaded files, failed file names).
+    """
+    stored_files = {
+        row["uuid"]: row
+        for row in fetch_data_from_db(
+            DATABASE_PATH,
+            "SELECT uuid, filesize, dateLastModified, sha256 FROM ujbuda_file_det WHERE folder_uuid = ?",
+            (folder_uuid,),
+        )
+    }
+
+    def fetch_file(file_item):
+        stored_path = stored_pdf_path(stored_files.get(file_item.get("uuid")), file_item)
+        if stored_path:
+            return stored_path, None
+
+        file_download_url = f"{ujbuda.base_url}/getfile/{file_item.get('uuid')}/{file_item.get('name')}"
+        spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+        try:
+            with session.get(file_download_url, timeout=10, stream=True, verify=False) as file_response:
+                file_response.raise_for_status()
+                for chunk in file_response.iter_content(1024 * 1024):
+                    spool.write(chunk)
+        except requests.RequestException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return None, spool
+
+    part_path = zip_path.with_name(f"{zip_path.name}.{threading.get_ident()}.part")
+    stored_count = 0
+    downloaded_count = 0
+    failed_names = []
+    arcnames = set()
+
+    with zipfile.ZipFile(part_path, "w") as zipf, ThreadPoolExecutor(ZIP_DOWNLOAD_WORKERS) as pool:
+        futures = [(file_item, pool.submit(fetch_file, file_item)) for file_item in file_items]
+        for file_item, future in futures:
+            file_name = file_item.get("name")
+            try:
+                stored_path, spool = future.result()
+            except requests.RequestException:
+                failed_names.append(file_name)
+                continue
+
+            # Agendas may attach files with the same name
+            arcname = file_name
+            number = 1
+            while arcname in arcnames:
+                number += 1
+                arcname = f"{Path(file_name).stem}_{number}{Path(file_name).suffix}"
+            arcnames.add(arcname)
+
+            compress_type = zipfile.ZIP_STORED if file_name.lower().endswith(".pdf") else zipfile.ZIP_DEFLATED
+            if stored_path:
+                zipf.write(stored_path, arcname, compress_type=compress_type)
+                stored_count += 1
+            else:
+                zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                zip_info.compress_type = compress_type
+                with spool, zipf.open(zip_info, "w") as entry:
+                    shutil.copyfileobj(spool, entry, 1024 * 1024)
+                downloaded_count += 1
+
+    if failed_names:
+        return part_path, stored_count, downloaded_count, failed_names
+    os.replace(part_path, zip_path)
+    return zip_path, stored_count, downloaded_count, failed_names
 
-mappa_data = fetch_data_from_db(DATABASE_PATH, mappa_query)
-napi_data = fetch_data_from_db(DATABASE_PATH, napi_query)
 
 # Sidebar Navigation
 st.sidebar.title("Navigáció")
@@ -73,104 +244,151 @@ if app_mode == "Kereső":
 
     search_text = st.sidebar.text_input("Keresendő szöveg", "")
     exact_match = st.sidebar.checkbox("Pontos egyezés", value=False)
+    regex_match = st.sidebar.checkbox(
+        "Reguláris kifejezés (szavakon belül)", value=False, disabled=not backend.supports_regex
+    )
     search_button = st.sidebar.button("Keresés")
 
-    unique_names = sorted({entry["name"] for entry in mappa_data})
+    unique_names = store.unique_names
     select_all = st.sidebar.checkbox("Mind kiválasztása", value=True)
     selected_names = st.sidebar.multiselect(
         "Név szerinti szűrés",
         unique_names,
         default=unique_names if select_all else [],
     )
+    first_date = store.first_date
+    last_date = store.last_date
+    date_range = st.sidebar.date_input(
+        "Dátum szerinti szűrés",
+        value=(first_date, last_date),
+        min_value=first_date,
+        max_value=last_date,
+    )
+    # While only the start of the range is picked the widget returns one date
+    date_from, date_to = (tuple(date_range) + (None, None))[:2]
+    page_size = st.sidebar.selectbox("Találatok oldalanként", [10, 20, 50, 100], index=1)
+    time_limit = st.sidebar.number_input(
+        "Időkorlát (másodperc, 0 = nincs)", min_value=0.0, value=0.0, step=0.5
+    )
 
-    def build_regex(search_text, exact_match):
-        pattern = (
-            rf"\b{re.escape(search_text)}\b" if exact_match else re.escape(search_text)
-        )
-        return re.compile(pattern)
+    # Start from the first page whenever the search changes
+    search_key = (search_text, exact_match, regex_match, page_size, tuple(selected_names), date_from, date_to)
+    if st.session_state.get("search_key") != search_key:
+        st.session_state.search_key = search_key
+        st.session_state.page_number = 1
+
+    def change_page(step):
+        st.session_state.page_number += step
 
     if search_text or search_button:
         st.divider()
-        with ix.searcher() as searcher:
-            start_time = time.time()
-            regex = build_regex(search_text, exact_match=exact_match)
-            # query = QueryParser("content", ix.schema).parse(regex)
-            query = Regex("content", regex.pattern)
-            results = searcher.search(query, limit=None, sortedby="date", reverse=True)
-            matched_files = results.scored_length()
-            total_files = searcher.doc_count_all()
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            percentage_matched = (
-                (matched_files / total_files) * 100 if total_files else 0
-            )
+        start_time = time.time()
+        # The full name list and the full date range need no restriction
+        request = SearchRequest(
+            search_text,
+            exact_match,
+            regex_match,
+            session_names=None if len(selected_names) == len(unique_names) else tuple(selected_names),
+            date_from=datetime.datetime.combine(date_from, datetime.time.min)
+            if date_from and date_from > first_date
+            else None,
+            date_to=datetime.datetime.combine(date_to, datetime.time.max)
+            if date_to and date_to < last_date
+            else None,
+            pagenum=st.session_state.page_number,
+            pagelen=page_size,
+        )
 
-            st.write(
-                """A nyilvánosan nem elérhető előterjesztési dokumentumok, 
+        try:
+            cache_key = backend.cache_key(request)
+            page = result_cache.get(cache_key, generation)
+            if page is None:
+                page = backend.search(request, time_limit or None)
+                if not page["partial"]:
+                    result_cache.put(cache_key, generation, page)
+        except QueryError as e:
+            st.error(str(e))
+            st.stop()
+
+        matched_files = page["total"]
+        if page["pagenum"]:
+            st.session_state.page_number = page["pagenum"]
+        total_files = page["total_files"]
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        percentage_matched = (
+            (matched_files / total_files) * 100 if total_files else 0
+        )
+
+        st.write(
+            """A nyilvánosan nem elérhető előterjesztési dokumentumok, 
 		    illetve a döntési javaslatok és azok mellékletei nem szerepelnek az adatbázisban."""
-            )
-            st.divider()
+        )
+        st.divider()
 
-            st.write(f"Feldolgozott fájlok száma: {total_files}")
-            st.write(
-                f"Találatok: {matched_files} dokumentum ({percentage_matched:.2f}%)"
-            )
-            st.write(f"Feldolgozási idő: {elapsed_time:.2f} másodperc")
-            st.divider()
+        st.write(f"Feldolgozott fájlok száma: {total_files}")
+        st.write(
+            f"Találatok: {matched_files} dokumentum ({percentage_matched:.2f}%)"
+        )
+        if page["partial"]:
+            st.warning("Az időkorlát lejárt, a találati lista részleges.")
+        st.write(f"Feldolgozási idő: {elapsed_time:.2f} másodperc")
+        st.divider()
+
+        for hit in page["hits"]:
+            # Indexes built before the metadata was stored fall back to the tables loaded at startup
+            session_name = hit["session_name"] or mappa_by_uuid.get(hit["folder_uuid"], {}).get("name")
+            agenda_title = hit["agenda_title"] or napi_by_uuid.get(hit["agenda_uuid"], {}).get("targy")
+            meghivo_link = f"https://mikrodat.ujbuda.hu/web/inv/{hit['folder_uuid']}"
+            document_link = f"{ujbuda.base_url}/getfile/{hit['document_uuid']}/{hit['file_name']}"
+            st.write(f"{session_name}")
+            st.write(f"**Dátum:** {hit['date'].strftime('%Y %m %d')}")
+            st.write(f"**Napirendi pont:** {agenda_title}")
+
+            if hit["snippets"]:
+                st.write(f"**Találat az oldalakon:** {', '.join(str(number) for number in hit['pages'])}")
+                st.write("Szövegkontextus: ")
+                for page_number, snippet_text in hit["snippets"]:
+                    st.write(f"{page_number}. oldal")
+                    st.code(snippet_text)
+                    st.link_button(f"Dokumentum, {page_number}. oldal", f"{document_link}#page={page_number}")
+                st.link_button("Meghívó", meghivo_link)
+                st.link_button("Dokumentum", document_link)
 
-            for result in results:
-                with sqlite3.connect(DATABASE_PATH) as conn:
-                    cur = conn.cursor()
-
-                    agenda_uuid = result["agenda_uuid"]
-                    folder_uuid = result["folder_uuid"]
-                    file_name = result['file_name'].replace("txt","pdf")
-                    
-                    file_path = Path(
-                        TXT_FOLDER
-                        / result["folder_uuid"]
-                        / result["agenda_uuid"]
-                        / result["file_name"]
+            else:
+                st.write("Nem megjeleníthető kontextus")
+
+            # The same text attached elsewhere is one hit with a link to every copy
+            copies = hit.get("copies", [])[1:]
+            if copies:
+                st.write(f"**Ugyanez a dokumentum további {len(copies)} helyen:**")
+                for copy in copies:
+                    copy_session = copy["session_name"] or mappa_by_uuid.get(copy["folder_uuid"], {}).get("name")
+                    copy_agenda = copy["agenda_title"] or napi_by_uuid.get(copy["agenda_uuid"], {}).get("targy")
+                    st.markdown(
+                        f"- {copy['date'].strftime('%Y %m %d')} {copy_session}, {copy_agenda}: "
+                        f"[Dokumentum]({ujbuda.base_url}/getfile/{copy['document_uuid']}/{copy['file_name']}) · "
+                        f"[Meghívó](https://mikrodat.ujbuda.hu/web/inv/{copy['folder_uuid']})"
                     )
-                    
-                    meghivo_link = f"https://mikrodat.ujbuda.hu/web/inv/{folder_uuid}"
-                    document_link = f"https://mikrodat.ujbuda.hu/app/cms/api/honlap/getfile/{result['document_uuid']}/{file_name}"
-                    
-                    cur.execute(
-                        f"SELECT * FROM {ujbuda.db_folder} WHERE folder_uuid='{folder_uuid}'"
-                    )                    
-                    
-                    folder_details = cur.fetchone()
-                    session_type = folder_details[3]
-                    
-                    if session_type in selected_names:
-                        cur.execute(
-                            f"SELECT * FROM {ujbuda.db_napirendi} WHERE uuid='{agenda_uuid}'"
-                        )
-                        agenda_details = cur.fetchone()
-                        st.write(f"{session_type}")
-                        # st.write(file_path)
-                        st.write(f"**Dátum:** {result['date'].strftime('%Y %m %d')}")
-                        st.write(f"**Napirendi pont:** {agenda_details[3]}")
-                        
-                        context = None
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            lines = f.readlines()
-                            for i, line in enumerate(lines):
-                                if regex.search(line):
-                                    start, end = max(0, i - 3), min(len(lines), i + 4)
-                                    context = "".join(lines[start:end]).strip()
-                                    break
-                        if context:
-                            st.write("Szövegkontextus: ")
-                            st.code(context)
-                            st.link_button("Meghívó", meghivo_link)
-                            st.link_button("Dokumentum", document_link)
-                            
-                        else:
-                            st.write("Nem megjeleníthető kontextus")
-                        st.divider()
+            st.divider()
+
+        if page["pagecount"] > 1:
+            prev_col, page_col, next_col = st.columns(3)
+            prev_col.button(
+                "Előző", on_click=change_page, args=(-1,), disabled=page["pagenum"] <= 1
+            )
+            page_col.write(f"{page['pagenum']}. oldal / {page['pagecount']}")
+            next_col.button(
+                "Következő",
+                on_click=change_page,
+                args=(1,),
+                disabled=page["pagenum"] >= page["pagecount"],
+            )
 
+        st.caption(
+            f"Gyorsítótár: {result_cache.hits} találat, {result_cache.misses} kihagyás, "
+            f"{len(result_cache.entries)} bejegyzés ({result_cache.size / 1e6:.1f} MB)"
+        )
 
 elif app_mode == "ZIP Letöltő":
     # ZIP Downloader Application
@@ -181,8 +399,12 @@ elif app_mode == "ZIP Letöltő":
     year = datetime.datetime.now().year
     folder_year_url = f"{ujbuda.base_url}/inv/folders?year={year}"
 
-    response = requests.get(folder_year_url, verify=False)
-    if response.status_code == 200:
+    api_session = get_api_session()
+    try:
+        response = api_session.get(folder_year_url, verify=False, timeout=10)
+    except requests.RequestException:
+        response = None
+    if response is not None and response.status_code == 200:
         available_dates = [f"{entry['datum']} {entry['idopont']}" 
         for entry in response.json()["content"]][::-1]
         selected_date = st.sidebar.selectbox("Válasszon dátumot:", available_dates)
@@ -208,12 +430,11 @@ elif app_mode == "ZIP Letöltő":
                 st.error("A megadott dátumhoz nincs elérhető mappa!")
             else:
                 st.write(f"Mappa UUID: {folder_uuid}")
-                folder_path = DOWNLOAD_FOLDER / folder_uuid
-                os.makedirs(folder_path, exist_ok=True)
+                os.makedirs(ZIP_CACHE_FOLDER, exist_ok=True)
 
                 # Fetch Folder Details
                 folder_detail_url = f"{ujbuda.base_url}/detail?id={folder_uuid}"
-                folder_detail_json = requests.get(folder_detail_url, verify=False)
+                folder_detail_json = api_session.get(folder_detail_url, verify=False)
                 session_type = folder_detail_json.json()["content"]["nev"]
                 session_uuid = folder_detail_json.json()["content"]["uuid"]
 
@@ -229,7 +450,7 @@ elif app_mode == "ZIP Letöltő":
 
                 # Get Agenda Points
                 st.write(body_agenda_url)
-                agenda_json = requests.get(body_agenda_url, verify=False)
+                agenda_json = api_session.get(body_agenda_url, verify=False)
                 # st.write(agenda_json.json())
                 doc_uuid_list = [
                     point["uuid"]
@@ -253,42 +474,36 @@ elif app_mode == "ZIP Letöltő":
                 st.write("Nem nyilvános dokumentumok:")
                 st.write(not_public_docs)
 
-                # Download Files
-                for doc_uuid in doc_uuid_list:
+                # Fetch the file lists of the agenda points concurrently
+                def fetch_agenda_files(doc_uuid):
                     body_dok_url = f"{ujbuda.base_url}/elo/djav?uuid={folder_uuid}&uuid2={doc_uuid}"
-                    body_file_json = requests.get(body_dok_url, verify=False)
+                    return api_session.get(body_dok_url, verify=False, timeout=10).json().get("content") or []
 
-                    if not body_file_json.json()["content"]:
-                        continue
+                with ThreadPoolExecutor(ZIP_DOWNLOAD_WORKERS) as pool:
+                    file_items = [
+                        file_item
+                        for agenda_files in pool.map(fetch_agenda_files, doc_uuid_list)
+                        for file_item in agenda_files
+                    ]
 
-                    # 9) Save pdfs
-                    for file_item in body_file_json.json().get("content", []):
-                        file_name = file_item.get("name")
-                        file_uuid = file_item.get("uuid")
-
-                        file_download_url = (
-                            f"{ujbuda.base_url}/getfile/{file_uuid}/{file_name}"
-                        )
-
-                        file_response = requests.get(file_download_url, timeout=10)
-                        file_response.raise_for_status()
-                        save_path = folder_path / file_name
-
-                    with open(save_path, "wb") as file:
-                        file.write(file_response.content)
-
-                # Create ZIP Archive
                 zip_name = target_date[0].replace(".", "_") + target_date[1].replace(".", "_") + ".zip"
-                zip_archive = DOWNLOAD_FOLDER / zip_name
-                with zipfile.ZipFile(zip_archive, "w", zipfile.ZIP_DEFLATED) as zipf:
-                    for root, dirs, files in os.walk(folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, start=folder_path)
-                            zipf.write(file_path, arcname)
+                zip_path = zip_cache_path(folder_uuid, file_items)
+                failed_names = []
+                if zip_path.exists():
+                    st.write("A ZIP már elkészült korábban, nem változott azóta.")
+                    os.utime(zip_path)
+                else:
+                    zip_path, stored_count, downloaded_count, failed_names = build_session_zip(
+                        api_session, folder_uuid, file_items, zip_path
+                    )
+                    st.write(f"Helyi tárból: {stored_count} fájl, letöltve: {downloaded_count} fájl")
+                    if failed_names:
+                        st.warning(f"Nem sikerült letölteni: {', '.join(failed_names)}")
+                    else:
+                        prune_zip_cache(zip_path, folder_uuid)
 
                 # Provide ZIP for Download
-                with open(zip_archive, "rb") as zip_file:
+                with open(zip_path, "rb") as zip_file:
                     st.download_button(
                         label="Letöltés ZIP formátumban",
                         data=zip_file,
@@ -296,7 +511,7 @@ elif app_mode == "ZIP Letöltő":
                         mime="application/zip",
                     )
 
-                # Clean Up
-                shutil.rmtree(folder_path)
-                os.remove(zip_archive)
-                st.success("Feldolgozás és tisztítás befejezve!")
+                # Incomplete archives are not cached
+                if failed_names:
+                    os.remove(zip_path)
+                st.success("Feldolgozás befejezve!")
@@ -0,0 +1,346 @@
+"""
+Keresőmotorok: Whoosh index vagy SQLite FTS5 tábla
+"""
+import datetime
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing, contextmanager
+
+from search import (
+    LineMatcher,
+    build_filter,
+    build_query,
+    find_page_snippets,
+    match_positions,
+    search_page,
+)
+
+
+class QueryError(ValueError):
+    """The search text cannot be searched with the backend, shown to the user."""
+
+
+# session_names=None means every session, the dates are inclusive datetimes or None
+SearchRequest = namedtuple(
+    "SearchRequest",
+    ["search_text", "exact_match", "regex", "session_names", "date_from", "date_to", "pagenum", "pagelen"],
+    defaults=(False, False, None, None, None, 1, 20),
+)
+
+
+def matching_copy_first(copies, request):
+    """Move the newest copy matching the session and date filters of the
+    request to the front, so the hit shows the copy that was searched for.
+
+    The others keep their order; without filters copies is returned as is.
+    """
+    for i, copy in enumerate(copies):
+        if (
+            (request.session_names is None or copy["session_name"] in request.session_names)
+            and (request.date_from is None or copy["date"] >= request.date_from)
+            and (request.date_to is None or copy["date"] <= request.date_to)
+        ):
+            return [copy] + copies[:i] + copies[i + 1:]
+    return copies
+
+
+class SearchBackend:
+    """Interface of the search backends used by the webservice.
+
+    search() returns one page of hits as a dict: "hits" (dicts with
+    session_name, agenda_title, date, folder_uuid, agenda_uuid,
+    document_uuid, file_name of the PDF, pages, snippets as (page, text)
+    pairs and copies), "total", "pagenum", "pagecount", "total_files" and
+    "partial" (the time limit ran out). A hit stands for every copy of the
+    same text; copies lists them as dicts with the same session, agenda
+    and file keys, the first one is the hit itself: the newest copy
+    matching the session and date filters, followed by the others newest
+    first. cache_key() is the normalized form
+    of the request, equal for requests with the same results. Both raise
+    QueryError for search texts the backend cannot search.
+    """
+
+    name = None
+    supports_regex = False
+
+    def cache_key(self, request):
+        raise NotImplementedError
+
+    def search(self, request, timelimit=None):
+        raise NotImplementedError
+
+
+class WhooshBackend(SearchBackend):
+    """Searches an opened Whoosh index, newest documents first.
+
+    With persistent=True every thread keeps its own searcher open instead
+    of opening one per search.
+    """
+
+    name = "whoosh"
+    supports_regex = True
+
+    def __init__(self, ix, trigram_index, txt_folder, snippet_pages=3, persistent=False):
+        self.ix = ix
+        self.trigram_index = trigram_index
+        self.txt_folder = txt_folder
+        self.snippet_pages = snippet_pages
+        self.local = threading.local() if persistent else None
+
+    @contextmanager
+    def searcher(self):
+        if self.local is None:
+            with self.ix.searcher() as searcher:
+                yield searcher
+            return
+        # Whoosh searchers are not shared between threads
+        if getattr(self.local, "searcher", None) is None:
+            self.local.searcher = self.ix.searcher()
+        yield self.local.searcher
+
+    def queries(self, request):
+        try:
+            query = build_query(
+                self.ix.schema,
+                request.search_text,
+                request.exact_match,
+                regex=request.regex,
+                trigram_index=self.trigram_index,
+            )
+        except re.error as e:
+            raise QueryError(f"Hibás reguláris kifejezés: {e}") from e
+        filter_query = build_filter(
+            self.ix.schema,
+            session_names=request.session_names,
+            date_from=request.date_from,
+            date_to=request.date_to,
+        )
+        return query, filter_query
+
+    def cache_key(self, request):
+        # The query objects are the normalized form of the search text and the filters
+        query, filter_query = self.queries(request)
+        return (self.name, str(query), request.exact_match, str(filter_query), request.pagenum, request.pagelen)
+
+    def search(self, request, timelimit=None):
+        query, filter_query = self.queries(request)
+        line_matcher = LineMatcher(self.ix.schema, request.search_text, request.exact_match, regex=request.regex)
+
+        with self.searcher() as searcher:
+            results, partial = search_page(
+                searcher, query, request.pagenum, request.pagelen, timelimit=timelimit, filter_query=filter_query
+            )
+            positions = match_positions(searcher, query, [result.docnum for result in results])
+
+            hits = []
+            for result in results:
+                txt_path = self.txt_folder / result["folder_uuid"] / result["agenda_uuid"] / result["file_name"]
+                pages, snippets = find_page_snippets(
+                    txt_path, positions.get(result.docnum), line_matcher, max_pages=self.snippet_pages
+                )
+                # Indexes built before duplicates were merged have one copy per entry
+                copies = result.get("copies") or [{
+                    "session_name": result.get("session_name"),
+                    "agenda_title": result.get("agenda_title"),
+                    "date": result["date"],
+                    "folder_uuid": result["folder_uuid"],
+                    "agenda_uuid": result["agenda_uuid"],
+                    "document_uuid": result["document_uuid"],
+                    "file_name": result["file_name"].replace("txt", "pdf"),
+                }]
+                copies = matching_copy_first(copies, request)
+                hits.append(dict(
+                    copies[0],
+                    pages=pages,
+                    snippets=[(snippet.page, snippet.text) for snippet in snippets],
+                    copies=copies,
+                ))
+
+            return {
+                "hits": hits,
+                "total": results.total,
+                "pagenum": results.pagenum,
+                "pagecount": results.pagecount,
+                "total_files": searcher.doc_count(),
+                "partial": partial,
+            }
+
+
+class Fts5Backend(SearchBackend):
+    """Searches the FTS5 table the updater fills in onkorm.db, one row per page.
+
+    The table is tokenized with unicode61 remove_diacritics, so every search
+    is case- and accent-insensitive. A single word matches as a prefix, an
+    exact single word or several words as a phrase; substrings inside words
+    and regular expressions are not supported. Hits are ordered by date
+    (order="date") or by the best bm25 rank of their pages (order="rank").
+    With persistent=True every thread keeps its database connection open.
+    """
+
+    name = "fts5"
+
+    def __init__(self, database_path, snippet_pages=3, order="date", snippet_tokens=40, persistent=False,
+                 fts_table="ujbuda_fts", db_folder="ujbuda_meghivo_mappa",
+                 db_napirendi="ujbuda_napirendi", db_file_detail="ujbuda_file_det"):
+        self.database_path = database_path
+        self.snippet_pages = snippet_pages
+        self.order = order
+        self.snippet_tokens = snippet_tokens
+        self.fts_table = fts_table
+        self.db_folder = db_folder
+        self.db_napirendi = db_napirendi
+        self.db_file_detail = db_file_detail
+        self.local = threading.local() if persistent else None
+
+    @contextmanager
+    def connect(self):
+        # Read-only; the database is in WAL mode so the updater can write meanwhile
+        if self.local is None:
+            with closing(sqlite3.connect(f"file:{self.database_path}?mode=ro", uri=True)) as conn:
+                yield conn
+            return
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = sqlite3.connect(f"file:{self.database_path}?mode=ro", uri=True)
+        yield self.local.conn
+
+    def match_expression(self, request):
+        if request.regex:
+            raise QueryError("Az FTS5 kereső nem támogatja a reguláris kifejezéseket.")
+        # Only word characters, so the quoted phrase needs no escaping
+        words = re.findall(r"\w+", request.search_text.lower())
+        if not words:
+            return None
+        if len(words) == 1 and not request.exact_match:
+            return f'"{words[0]}"*'
+        return '"' + " ".join(words) + '"'
+
+    def filters(self, request):
+        # Sessions without a valid date are not indexed by Whoosh either
+        conditions = ["m.datum GLOB '[0-9][0-9][0-9][0-9].[0-9][0-9].[0-9][0-9].'"]
+        params = []
+        if request.session_names is not None:
+            conditions.append(f"m.name IN ({', '.join('?' * len(request.session_names))})")
+            params.extend(request.session_names)
+        # datum is stored as YYYY.MM.DD., which sorts as text
+        if request.date_from:
+            conditions.append("m.datum >= ?")
+            params.append(request.date_from.strftime("%Y.%m.%d."))
+        if request.date_to:
+            conditions.append("m.datum <= ?")
+            params.append(request.date_to.strftime("%Y.%m.%d."))
+        return " AND ".join(conditions), params
+
+    def cache_key(self, request):
+        session_names = tuple(request.session_names) if request.session_names is not None else None
+        return (
+            self.name, self.match_expression(request), session_names,
+            request.date_from, request.date_to, self.order, request.pagenum, request.pagelen,
+        )
+
+    def search(self, request, timelimit=None):
+        match = self.match_expression(request)
+        empty_page = {"hits": [], "total": 0, "pagenum": 1, "pagecount": 0, "total_files": 0, "partial": False}
+
+        with self.connect() as conn:
+            try:
+                empty_page["total_files"] = conn.execute(f"SELECT COUNT(*) FROM {self.fts_table}_docs").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                raise QueryError("Az FTS5 index még nem készült el, az updater következő futása hozza létre.") from e
+            if match is None:
+                return empty_page
+
+            if timelimit:
+                deadline = time.monotonic() + timelimit
+                conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try:
+                rows, total, pagenum = self.select_documents(conn, match, request)
+                hits = [self.resolve_hit(conn, match, request, row) for row in rows]
+            except sqlite3.OperationalError as e:
+                if "interrupted" not in str(e):
+                    raise
+                return dict(empty_page, partial=True)
+            finally:
+                # The connection may be kept for the next search
+                conn.set_progress_handler(None, 0)
+
+        pagecount = (total + request.pagelen - 1) // request.pagelen
+        return dict(empty_page, hits=hits, total=total, pagenum=pagenum if total else 1, pagecount=pagecount)
+
+    def select_documents(self, conn, match, request):
+        """Return (rows of the requested page, total documents, page number).
+
+        bm25() only works in the query that runs the MATCH, so the matching
+        pages are materialized first and grouped by document afterwards.
+        """
+        where, params = self.filters(request)
+        order = "best_rank, newest DESC" if self.order == "rank" else "newest DESC, best_rank"
+        # The pages are stored once for every copy of a text (content_uuid),
+        # a document matches the filters if any of its copies does
+        query = f"""WITH matches AS MATERIALIZED (
+                SELECT document_uuid, page, bm25({self.fts_table}) AS rank
+                FROM {self.fts_table} WHERE {self.fts_table} MATCH ?
+            )
+            SELECT matches.document_uuid, MIN(matches.rank) AS best_rank, GROUP_CONCAT(DISTINCT matches.page),
+                MAX(m.datum) AS newest, COUNT(*) OVER () AS total
+            FROM matches
+            JOIN {self.db_file_detail} f ON f.uuid = matches.document_uuid OR f.content_uuid = matches.document_uuid
+            JOIN {self.db_folder} m ON m.folder_uuid = f.folder_uuid
+            WHERE {where}
+            GROUP BY matches.document_uuid
+            ORDER BY {order}, matches.document_uuid
+            LIMIT ? OFFSET ?"""
+
+        pagenum = max(1, request.pagenum)
+        rows = conn.execute(query, [match] + params + [request.pagelen, (pagenum - 1) * request.pagelen]).fetchall()
+        if not rows and pagenum > 1:
+            # Past the last page, e.g. after an update removed hits: show the last one
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM ({query})", [match] + params + [-1, 0]
+            ).fetchone()[0]
+            pagenum = max(1, (total + request.pagelen - 1) // request.pagelen)
+            rows = conn.execute(query, [match] + params + [request.pagelen, (pagenum - 1) * request.pagelen]).fetchall()
+        total = rows[0][-1] if rows else 0
+        return rows, total, pagenum
+
+    def resolve_hit(self, conn, match, request, row):
+        document_uuid, _, pages, _, _ = row
+        first_rowid, page_count = conn.execute(
+            f"SELECT first_rowid, page_count FROM {self.fts_table}_docs WHERE document_uuid = ?", (document_uuid,)
+        ).fetchone()
+        # The rowid range keeps the snippet query to the pages of this document
+        snippets = conn.execute(
+            f"""SELECT page, snippet({self.fts_table}, 2, '', '', ' … ', ?)
+            FROM {self.fts_table} WHERE {self.fts_table} MATCH ? AND rowid BETWEEN ? AND ?
+            ORDER BY rowid LIMIT ?""",
+            (self.snippet_tokens, match, first_rowid, first_rowid + page_count - 1, self.snippet_pages),
+        ).fetchall()
+        copies = {}
+        for file_uuid, folder_uuid, agenda_uuid, file_name, datum, session_name, agenda_title in conn.execute(
+            f"""SELECT f.uuid, f.folder_uuid, f.agenda_uuid, f.name, m.datum, m.name, n.targy
+            FROM {self.db_file_detail} f
+            JOIN {self.db_folder} m ON m.folder_uuid = f.folder_uuid
+            LEFT JOIN {self.db_napirendi} n ON n.uuid = f.agenda_uuid
+            WHERE (f.uuid = ? OR f.content_uuid = ?) AND m.datum GLOB '[0-9][0-9][0-9][0-9].[0-9][0-9].[0-9][0-9].'
+            ORDER BY m.datum DESC, f.rowid DESC""",
+            (document_uuid, document_uuid),
+        ):
+            # The same file listed twice is linked under its latest uuid
+            copies.setdefault((folder_uuid, agenda_uuid, file_name), {
+                "session_name": session_name,
+                "agenda_title": agenda_title,
+                "date": datetime.datetime.strptime(datum, "%Y.%m.%d."),
+                "folder_uuid": folder_uuid,
+                "agenda_uuid": agenda_uuid,
+                "document_uuid": file_uuid,
+                "file_name": file_name,
+            })
+        copies = matching_copy_first(list(copies.values()), request)
+        return dict(
+            copies[0],
+            pages=sorted(int(page) for page in pages.split(",")),
+            snippets=[(page, text.strip()) for page, text in snippets],
+            copies=copies,
+        )
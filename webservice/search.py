@@ -0,0 +1,528 @@
+"""
+Keresési lekérdezések
+"""
+import datetime
+import heapq
+import mmap
+import pickle
+import re
+import sqlite3
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+from pathlib import Path
+
+from whoosh.collectors import FilterCollector, SortingCollector, TimeLimit, TimeLimitCollector
+from whoosh.query import And, DateRange, NullQuery, NumericRange, Or, Phrase, Prefix, Term
+from whoosh.query.terms import MultiTerm, PatternQuery
+from whoosh.searching import ResultsPage
+from whoosh.support.charset import accent_map
+
+
+def fold_text(text):
+    """Lowercase and strip accents the same way as the content_folded field."""
+    return text.translate(accent_map).lower()
+
+
+def search_field(schema, exact_match):
+    # Indexes built before content_folded existed only have content
+    if exact_match or "content_folded" not in schema:
+        return "content"
+    return "content_folded"
+
+
+def query_words(schema, fieldname, search_text):
+    analyzer = schema[fieldname].analyzer
+    return [token.text for token in analyzer(search_text, mode="query")]
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Hex digits following the escape
+ESCAPE_ARGUMENT_LENGTHS = {"x": 2, "u": 4, "U": 8}
+
+
+def regex_literals(pattern):
+    """Return the literal runs that every match of a simple regex contains.
+
+    Only used to narrow the candidate terms, so it may return less than the
+    pattern requires but never more. Alternations and groups are not
+    analyzed and give no literals.
+    """
+    if "|" in pattern or "(" in pattern:
+        return []
+
+    runs = [[]]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if char == "\\":
+            escaped = pattern[i:i + 1]
+            i += 1
+            if escaped and not escaped.isalnum():
+                runs[-1].append(escaped)
+            else:
+                # \w, \d, \b..., skipping the argument of \xNN, \uNNNN,
+                # \UNNNNNNNN, \N{name}, octal escapes and backreferences
+                if escaped == "N" and pattern[i:i + 1] == "{":
+                    i = pattern.find("}", i) + 1 or len(pattern)
+                elif escaped in ESCAPE_ARGUMENT_LENGTHS:
+                    i += ESCAPE_ARGUMENT_LENGTHS[escaped]
+                elif escaped.isdigit():
+                    while pattern[i:i + 1].isdigit():
+                        i += 1
+                runs.append([])
+        elif char in "*?{":
+            # The previous character may be missing
+            if runs[-1]:
+                runs[-1].pop()
+            if char == "{":
+                i = pattern.find("}", i) + 1 or len(pattern)
+            runs.append([])
+        elif char == "[":
+            i = pattern.find("]", i + 1) + 1 or len(pattern)
+            runs.append([])
+        elif char in "+.^$":
+            runs.append([])
+        else:
+            runs[-1].append(char)
+
+    return ["".join(run) for run in runs if run]
+
+
+class TrigramIndex:
+    """Lookup of the content_folded terms by their trigrams.
+
+    The updater writes it next to the index as immutable segment files
+    (trigrams-NNNN.db), each holding the terms that were new in an update:
+    a terms table and a trigrams table with the sorted term ids (uint32,
+    native byte order) of every trigram.
+    """
+
+    def __init__(self, index_dir):
+        self.paths = sorted(Path(index_dir).glob("trigrams-*.db"))
+
+    def __bool__(self):
+        return bool(self.paths)
+
+    def candidate_terms(self, literals):
+        """Return the terms containing every trigram of the literals.
+
+        Returns None when no literal is long enough to have a trigram.
+        """
+        grams = set()
+        for literal in literals:
+            grams.update(trigrams(literal))
+        if not grams:
+            return None
+
+        terms = []
+        for path in self.paths:
+            with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+                rows = conn.execute(
+                    f"SELECT term_ids FROM trigrams WHERE trigram IN ({', '.join('?' * len(grams))})",
+                    list(grams),
+                ).fetchall()
+                if len(rows) < len(grams):
+                    continue
+
+                postings = sorted((array("I", blob) for (blob,) in rows), key=len)
+                term_ids = set(postings[0])
+                for posting in postings[1:]:
+                    term_ids.intersection_update(posting)
+                    if not term_ids:
+                        break
+
+                term_ids = sorted(term_ids)
+                for start in range(0, len(term_ids), 500):
+                    chunk = term_ids[start:start + 500]
+                    terms.extend(
+                        term for (term,) in conn.execute(
+                            f"SELECT term FROM terms WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                        )
+                    )
+        return terms
+
+
+class TrigramQuery(PatternQuery):
+    """Matches the terms that contain a substring, or match a regex anywhere.
+
+    The candidate terms come from the trigram index and are verified
+    against the pattern, so no lexicon scan is needed. Without trigram
+    segments, or when the pattern has no 3 character literal, the lexicon
+    is scanned instead.
+    """
+
+    def __init__(self, fieldname, text, trigram_index=None, regex=False, boost=1.0):
+        PatternQuery.__init__(self, fieldname, text, boost=boost)
+        self.trigram_index = trigram_index
+        self.regex = regex
+        self.expression = re.compile(text if regex else re.escape(text), re.IGNORECASE)
+        self._candidates = None
+
+    def __unicode__(self):
+        if self.regex:
+            return '%s:r"%s"' % (self.fieldname, self.text)
+        return "%s:*%s*" % (self.fieldname, self.text)
+
+    __str__ = __unicode__
+
+    def __eq__(self, other):
+        return PatternQuery.__eq__(self, other) and self.regex == other.regex
+
+    def __hash__(self):
+        return PatternQuery.__hash__(self) ^ hash(self.regex)
+
+    def candidates(self):
+        # Looked up once, the matcher asks for the terms of every segment
+        if self._candidates is None and self.trigram_index:
+            literals = regex_literals(self.text) if self.regex else [self.text]
+            terms = self.trigram_index.candidate_terms([literal.lower() for literal in literals])
+            if terms is not None:
+                self._candidates = [term for term in terms if self.expression.search(term)]
+        return self._candidates
+
+    def _btexts(self, ixreader):
+        candidates = self.candidates()
+        if candidates is None:
+            for btext in ixreader.lexicon(self.fieldname):
+                if self.expression.search(btext.decode("utf8")):
+                    yield btext
+            return
+
+        for term in candidates:
+            if (self.fieldname, term) in ixreader:
+                yield term.encode("utf8")
+
+
+def build_query(schema, search_text, exact_match, regex=False, trigram_index=None):
+    """Build the query from the analyzed search text.
+
+    Exact match is a phrase on the content field. Otherwise the words are
+    matched accent- and case-folded, and a single word also matches inside
+    longer words, e.g. "parkoló" and "ház" both find "parkolóház". With
+    regex the pattern is matched against every (folded) word.
+    """
+    if regex:
+        fieldname = search_field(schema, False)
+        pattern = search_text.strip().translate(accent_map)
+        return TrigramQuery(fieldname, pattern, trigram_index, regex=True) if pattern else NullQuery
+
+    fieldname = search_field(schema, exact_match)
+    words = query_words(schema, fieldname, search_text)
+
+    if not words:
+        return NullQuery
+    if len(words) > 1:
+        return Phrase(fieldname, words)
+    if exact_match:
+        return Term(fieldname, words[0])
+    # Substrings need the trigram index, indexes without it keep prefix matching
+    if trigram_index and len(words[0]) >= 3:
+        return TrigramQuery(fieldname, words[0], trigram_index)
+    return Prefix(fieldname, words[0])
+
+
+def session_date_key(session_name, date):
+    """Same as in the updater, which indexes it for every copy of a document."""
+    return zlib.crc32((session_name or "").encode("utf8")) * 100000000 + int(date.strftime("%Y%m%d"))
+
+
+def build_filter(schema, session_names=None, date_from=None, date_to=None):
+    """Build the query restricting the hits to the given sessions and dates.
+
+    session_names=None means every session. The dates are inclusive
+    datetimes, either may be None. Returns None when nothing is restricted.
+    A document with several copies matches if one copy matches both. An
+    empty session_names matches nothing.
+    """
+    if session_names is not None and not session_names:
+        # An empty Or is false, and the collector would not filter at all
+        return NullQuery
+    if session_names is not None and "session_dates" in schema:
+        date_from = date_from or datetime.datetime(1900, 1, 1)
+        date_to = date_to or datetime.datetime(2999, 12, 31)
+        return Or([
+            NumericRange("session_dates", session_date_key(name, date_from), session_date_key(name, date_to))
+            for name in session_names
+        ])
+
+    filters = []
+    # Indexes built before session_name was indexed cannot be filtered on it
+    if session_names is not None and "session_name" in schema and schema["session_name"].indexed:
+        filters.append(Or([Term("session_name", name) for name in session_names]))
+    if date_from or date_to:
+        # dates holds the date of every copy of a document, older indexes only date
+        filters.append(DateRange("dates" if "dates" in schema else "date", date_from, date_to))
+
+    if not filters:
+        return None
+    return And(filters) if len(filters) > 1 else filters[0]
+
+
+class TopSortingCollector(SortingCollector):
+    """SortingCollector that only selects the top `limit` hits instead of sorting all of them."""
+
+    def results(self):
+        if not self.limit:
+            return SortingCollector.results(self)
+        select = heapq.nlargest if self.reverse else heapq.nsmallest
+        return self._results(select(self.limit, self.items), docset=self.docset)
+
+
+class CollectFilterCollector(FilterCollector):
+    """FilterCollector that also filters the documents passed to collect().
+
+    TimeLimitCollector iterates the matches itself and calls collect() of
+    its child, which skipped the filtering done in collect_matches().
+    """
+
+    def collect(self, sub_docnum):
+        global_docnum = self.offset + sub_docnum
+        if (self._allow is not None and global_docnum not in self._allow) or (
+            self._restrict is not None and global_docnum in self._restrict
+        ):
+            self.filtered_count += 1
+            return None
+        return self.child.collect(sub_docnum)
+
+
+def search_page(searcher, query, pagenum=1, pagelen=20, timelimit=None, filter_query=None):
+    """Return one page of hits, newest first, and whether the search timed out.
+
+    Only the hits up to the requested page are selected. The total hit count
+    comes from the collected docset, so it already respects `filter_query`.
+    When `timelimit` (seconds) runs out the hits collected so far are
+    returned with partial=True.
+    """
+    collector = TopSortingCollector("date", limit=pagenum * pagelen, reverse=True)
+    partial = False
+
+    outer_collector = collector
+    if filter_query is not None:
+        outer_collector = CollectFilterCollector(outer_collector, allow=filter_query)
+
+    if timelimit:
+        # SIGALRM is not available outside the main thread (Streamlit runs scripts in a worker)
+        outer_collector = TimeLimitCollector(outer_collector, timelimit, use_alarm=False)
+        try:
+            searcher.search_with_collector(query, outer_collector)
+        except TimeLimit:
+            partial = True
+    else:
+        searcher.search_with_collector(query, outer_collector)
+
+    return ResultsPage(collector.results(), pagenum, pagelen), partial
+
+
+class LineMatcher:
+    """Finds the query words in a line of the original txt file."""
+
+    def __init__(self, schema, search_text, exact_match, regex=False):
+        self.word_regex = None
+        if regex:
+            self.folded = True
+            self.word_regex = re.compile(search_text.strip().translate(accent_map), re.IGNORECASE)
+            return
+
+        fieldname = search_field(schema, exact_match)
+        self.folded = fieldname == "content_folded"
+        words = [re.escape(word) for word in query_words(schema, fieldname, search_text)]
+        pattern = r"\W+".join(words)
+        # A single word also matches inside longer words
+        if exact_match or len(words) > 1:
+            pattern = r"\b" + pattern + r"\b"
+        self.regex = re.compile(pattern) if words else None
+
+    def search(self, line):
+        text = fold_text(line) if self.folded else line.lower()
+        if self.word_regex is not None:
+            for word in re.finditer(r"\w+", text):
+                if self.word_regex.search(word.group()):
+                    return word
+            return None
+        if self.regex is None:
+            return None
+        return self.regex.search(text)
+
+
+Snippet = namedtuple("Snippet", ["text", "line", "page"])
+
+
+def span_query(searcher, query):
+    # Prefix and substring queries match without positions, expand them to their terms
+    if isinstance(query, MultiTerm):
+        terms = query.expanded_terms(searcher.reader())
+        return Or([Term(fieldname, term.decode("utf8")) for fieldname, term in terms])
+    return query
+
+
+def match_positions(searcher, query, docnums):
+    """Return {docnum: sorted word positions of the matches} for the given hits."""
+    positions = {}
+    docnums = sorted(docnums)
+
+    for leaf_searcher, offset in searcher.leaf_searchers():
+        end = offset + leaf_searcher.doc_count_all()
+        leaf_docnums = [docnum - offset for docnum in docnums if offset <= docnum < end]
+        if not leaf_docnums:
+            continue
+
+        matcher = span_query(leaf_searcher, query).matcher(leaf_searcher)
+        for docnum in leaf_docnums:
+            if not matcher.is_active():
+                break
+            if matcher.id() < docnum:
+                matcher.skip_to(docnum)
+            if matcher.is_active() and matcher.id() == docnum:
+                spans = matcher.spans()
+                if spans:
+                    positions[docnum + offset] = sorted({span.start for span in spans})
+
+    return positions
+
+
+def line_offsets_path(txt_path):
+    return txt_path.with_name(txt_path.name + ".lines")
+
+
+def read_page_snippets(txt_path, positions, context_lines=3, max_pages=5):
+    """Map indexed word positions to pages and read a snippet on each page.
+
+    Uses the .lines sidecar: both files are memory mapped, and only the
+    lines around the first match of a page, clipped to that page, are read
+    whatever the size of the document. Returns (every matching page,
+    snippets of the first max_pages), or None when the sidecar is missing
+    or older than the txt file.
+    """
+    sidecar_path = line_offsets_path(txt_path)
+    try:
+        if sidecar_path.stat().st_mtime < txt_path.stat().st_mtime:
+            return None
+    except FileNotFoundError:
+        return None
+
+    pages = []
+    regions = []
+    with open(sidecar_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as sidecar:
+        magic, line_count, page_count, _ = struct.unpack_from("<4sIII", sidecar)
+        if magic != b"XIL1" or line_count == 0:
+            return None
+
+        with memoryview(sidecar) as view:
+            start = 16
+            byte_offsets = view[start:start + 8 * (line_count + 1)].cast("Q")
+            start += 8 * (line_count + 1)
+            word_positions = view[start:start + 4 * (line_count + 1)].cast("I")
+            start += 4 * (line_count + 1)
+            page_lines = view[start:start + 4 * page_count].cast("I")
+
+            for position in positions:
+                line = max(0, min(line_count - 1, bisect_right(word_positions, position) - 1))
+                page = bisect_right(page_lines, line)
+                if pages and pages[-1] == page:
+                    continue
+                pages.append(page)
+                if len(regions) < max_pages:
+                    page_start = page_lines[page - 1]
+                    page_end = page_lines[page] if page < page_count else line_count
+                    first_byte = byte_offsets[max(page_start, line - context_lines)]
+                    last_byte = byte_offsets[min(page_end, line + context_lines + 1)]
+                    regions.append((line, page, first_byte, last_byte))
+
+            for sub_view in (byte_offsets, word_positions, page_lines):
+                sub_view.release()
+
+    snippets = []
+    with open(txt_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+        for line, page, first_byte, last_byte in regions:
+            context = text[first_byte:last_byte].decode("utf8", errors="replace")
+            snippets.append(Snippet(context.replace("\f", "").strip(), line, page))
+
+    return pages, snippets
+
+
+def scan_snippet(txt_path, line_matcher, context_lines=3):
+    """Find the first matching line by reading the whole txt file."""
+    with open(txt_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        match = line_matcher.search(line)
+        if match:
+            start, end = max(0, i - context_lines), min(len(lines), i + context_lines + 1)
+            page = 1 + sum(previous.count("\f") for previous in lines[:i]) + line[:match.start()].count("\f")
+            return Snippet("".join(lines[start:end]).replace("\f", "").strip(), i, page)
+    return None
+
+
+def find_page_snippets(txt_path, positions, line_matcher, max_pages=5):
+    """Return (matching pages, per-page snippets) of a hit.
+
+    Without positions or an up to date sidecar only the first match found
+    by scanning the file is returned.
+    """
+    page_snippets = None
+    if positions:
+        page_snippets = read_page_snippets(txt_path, positions, max_pages=max_pages)
+    if page_snippets is None:
+        snippet = scan_snippet(txt_path, line_matcher)
+        page_snippets = ([snippet.page], [snippet]) if snippet else ([], [])
+    return page_snippets
+
+
+class ResultCache:
+    """Thread-safe LRU cache of resolved result pages.
+
+    Bounded by the number of entries and by their approximate (pickled)
+    size. Every entry is dropped when the data generation (index generation,
+    database modification time) differs from the one the entries were
+    stored under.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self.entries.clear()
+            self.size = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self.lock:
+            self._check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, generation, value):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._check_generation(generation)
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
@@ -0,0 +1,141 @@
+"""
+A keresőmotor és a metaadat-táblák, a Streamlit felület és a JSON API közös állapota
+"""
+import datetime
+import sqlite3
+import threading
+
+from whoosh import index
+
+from backends import Fts5Backend, WhooshBackend
+from search import TrigramIndex
+
+
+def fetch_data_from_db(database_path, query, params=()):
+    # Read-only; the database is in WAL mode so the updater can write meanwhile
+    with sqlite3.connect(f"file:{database_path}?mode=ro", uri=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def database_stamp(database_path):
+    # In WAL mode the writes land in the -wal file until a checkpoint
+    stamps = []
+    for path in (database_path, database_path.with_name(database_path.name + "-wal")):
+        try:
+            stamps.append(path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def current_index_dir(index_folder):
+    # The updater publishes generations under index_folder and links the current one
+    current_link = index_folder / "current"
+    if current_link.exists():
+        return current_link.resolve()
+    return index_folder
+
+
+class DataStore:
+    """The search backend and the metadata tables, shared by every session and rerun.
+
+    refresh() costs a directory listing and two stat calls. The Whoosh
+    index is reopened when the updater published a new generation, the
+    tables are reloaded when the database changed. With persistent=True
+    every thread keeps its searcher (or database connection) open between
+    searches, for servers with a fixed set of threads.
+    """
+
+    def __init__(self, database_path, txt_folder, index_folder, backend_name="whoosh", snippet_pages=3,
+                 fts_order="date", persistent=False, fts_table="ujbuda_fts", db_folder="ujbuda_meghivo_mappa",
+                 db_napirendi="ujbuda_napirendi", db_file_detail="ujbuda_file_det"):
+        self.database_path = database_path
+        self.txt_folder = txt_folder
+        self.index_folder = index_folder
+        self.backend_name = backend_name
+        self.snippet_pages = snippet_pages
+        self.persistent = persistent
+        self.db_folder = db_folder
+        self.db_napirendi = db_napirendi
+        self.lock = threading.Lock()
+        self.ix = None
+        self.index_dir = None
+        self.index_generation = None
+        self.db_stamp = None
+        self.backend = None
+        if backend_name == "fts5":
+            self.backend = Fts5Backend(
+                database_path,
+                snippet_pages=snippet_pages,
+                order=fts_order,
+                persistent=persistent,
+                fts_table=fts_table,
+                db_folder=db_folder,
+                db_napirendi=db_napirendi,
+                db_file_detail=db_file_detail,
+            )
+        self.refresh()
+
+    @property
+    def generation(self):
+        return (self.index_generation, self.db_stamp)
+
+    def refresh(self):
+        """Reload what the updater changed and return (backend, generation).
+
+        The pair is read under the lock, so a search run on the backend can
+        be cached under the generation: another thread may refresh the
+        store meanwhile, use the returned values instead of the attributes.
+        """
+        with self.lock:
+            if self.backend_name == "whoosh":
+                self._refresh_index()
+            self._refresh_tables()
+            return self.backend, self.generation
+
+    def _refresh_index(self):
+        # A newly published generation is a new directory, an index written
+        # in place gets a new TOC generation
+        try:
+            index_dir = current_index_dir(self.index_folder)
+            if index_dir == self.index_dir and self.ix.latest_generation() == self.index_generation[1]:
+                return
+            ix = index.open_dir(index_dir)
+        except (OSError, index.EmptyIndexError) as e:
+            if self.ix is None:
+                raise
+            # Keep searching the generation already open
+            print(f"Index reload failed, keeping generation {self.index_generation}: {e}")
+            return
+        self.ix = ix
+        self.trigram_index = TrigramIndex(index_dir)
+        self.backend = WhooshBackend(
+            ix, self.trigram_index, self.txt_folder, snippet_pages=self.snippet_pages, persistent=self.persistent
+        )
+        self.index_dir = index_dir
+        self.index_generation = (index_dir, ix.latest_generation())
+
+    def _refresh_tables(self):
+        db_stamp = database_stamp(self.database_path)
+        if db_stamp == self.db_stamp:
+            return
+        mappa_data = fetch_data_from_db(self.database_path, f"SELECT * FROM {self.db_folder}")
+        napi_data = fetch_data_from_db(self.database_path, f"SELECT * FROM {self.db_napirendi}")
+
+        folder_dates = []
+        for entry in mappa_data:
+            try:
+                folder_dates.append(datetime.datetime.strptime(entry["datum"], "%Y.%m.%d.").date())
+            except (TypeError, ValueError):
+                continue
+
+        self.mappa_by_uuid = {entry["folder_uuid"]: entry for entry in mappa_data}
+        self.napi_by_uuid = {entry["uuid"]: entry for entry in napi_data}
+        self.unique_names = sorted({entry["name"] for entry in mappa_data})
+        self.first_date = min(folder_dates, default=datetime.date.today())
+        self.last_date = max(folder_dates, default=datetime.date.today())
+        self.db_stamp = db_stamp